@@ -0,0 +1,308 @@
+''' Z-Wave NVM throughput benchmark and regression checks
+
+    Runs dump, fill, verify (read back and chip CRC16) and random read workloads thru TestNVM against the simulated SerialAPI device in SimZWave
+    and reports frames/s, bytes/s and the 50th/99th percentile round trip time of each SerialAPI request.
+    The data each workload moved is compared with the simulated flash - a bench that got it wrong is marked FAIL.
+    No Z-Wave hardware is needed so speedups can be measured and regression tested on any Linux box.
+
+    --check runs the correctness checks instead: dumps in every image format, write/restore/verify round trips,
+    a lossy link, a late response, checkpointed dumps and fills resumed after an interruption and the scripted commands.
+
+    Usage: python3 BenchNVM.py [--baud 115200] [--latency MS] [--nak P] [--can P] [--corrupt P]
+                              [--size BYTES] [--reads N] [--json FILE] [--check]
+    Exits with 1 if a bench or check failed.
+'''
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import TestNVM
+import SimZWave
+import NVMImage
+import NVMStream
+import NVMJournal
+
+def Percentile(values, p):
+    ''' Return the p (0-1) percentile of values'''
+    if not values:
+        return 0
+    values=sorted(values)
+    return values[int(round(p*(len(values)-1)))]
+
+def Timed(zw):
+    ''' Wrap Send2ZWave on the zw instance to record the round trip time of every request. Returns the list.'''
+    rtts=[]
+    send=zw.Send2ZWave
+    def Send2ZWave(*args, **kwargs):
+        start=time.time()
+        response=send(*args, **kwargs)
+        rtts.append(time.time()-start)
+        return response
+    zw.Send2ZWave=Send2ZWave
+    return rtts
+
+def Bench(name, zw, rtts, work):
+    ''' Run work() which returns the number of NVM bytes moved and whether the result was correct
+        and return the statistics of the run'''
+    del rtts[:]
+    start=time.time()
+    (nbytes, ok)=work()
+    elapsed=time.time()-start
+    return {"bench": name, "seconds": round(elapsed,3), "frames": len(rtts), "bytes": nbytes,
+            "frames_per_s": round(len(rtts)/elapsed,1), "bytes_per_s": round(nbytes/elapsed,1),
+            "rtt_p50_ms": round(1000*Percentile(rtts,0.50),2), "rtt_p99_ms": round(1000*Percentile(rtts,0.99),2),
+            "pass": bool(ok)}
+
+def RunBenchmarks(args):
+    ''' Run every benchmark against a fresh simulated device and return the list of results'''
+    sim=SimZWave.SimZWave(size=args.size, baud=args.baud, latency=args.latency/1000.0,
+                          nak=args.nak, can=args.can, corrupt=args.corrupt)
+    sim.flash[:]=random.Random(3).getrandbits(8*args.size).to_bytes(args.size,"big")
+    zw=TestNVM.TestNVM(sim.port)
+    try:
+        zw.ProbeReadBlock()             # probing is a one time cost - keep it out of the numbers
+        rtts=Timed(zw)
+        results=[]
+        def Dump():
+            data=zw.DumpNVM(args.size)
+            return (len(data or b""), data==sim.flash)
+        results.append(Bench("dump", zw, rtts, Dump))
+        pattern=bytearray(random.Random(1).getrandbits(8*args.size).to_bytes(args.size,"big"))
+        def Fill():
+            counts=zw.RestoreNVM(pattern)
+            return (counts[1] if counts else 0, counts!=None and sim.flash==pattern)
+        results.append(Bench("fill", zw, rtts, Fill))
+        def Refill():                   # same data again - everything should be skipped
+            counts=zw.RestoreNVM(pattern)
+            return (counts[0] if counts else 0, counts==(len(pattern),0,0))
+        results.append(Bench("fill-unchanged", zw, rtts, Refill))
+        def Verify():
+            bad=zw.VerifyNVM(pattern)
+            return (len(pattern) if bad==0 else 0, bad==0)
+        results.append(Bench("verify", zw, rtts, Verify))
+        def VerifyCRC():                # same check with the CRC16 computed on the chip - nothing is read back
+            counts=zw.VerifyCRC(pattern)
+            return (len(pattern) if counts and counts[0]==0 else 0, counts!=None and counts[:2]==(0,0))
+        results.append(Bench("verify-crc", zw, rtts, VerifyCRC))
+        rng=random.Random(2)
+        def RandomReads():
+            nbytes=0
+            ok=True
+            for i in range(args.reads):
+                length=rng.randint(1,256)
+                addr=rng.randrange(0,args.size-length)
+                data=zw.ReadNVM(addr, length)
+                nbytes+=len(data or b"")
+                ok=ok and data==sim.flash[addr:addr+length]
+            return (nbytes, ok)
+        results.append(Bench("random-read", zw, rtts, RandomReads))
+    finally:
+        zw.Close()
+        sim.Close()
+    return results
+
+class Interrupt(Exception):
+    ''' Stands in for a ^C or a crash in the middle of a checkpointed operation'''
+    pass
+
+def Expect(condition, message):
+    ''' Fail the running check with message unless condition holds - unlike assert it works with python -O'''
+    if not condition:
+        raise AssertionError(message)
+
+def InterruptAfter(zw, name, calls):
+    ''' Make method name of zw raise Interrupt after it has been called calls times. Returns a function undoing it.'''
+    real=getattr(zw, name)
+    count=[0]
+    def Method(*args):
+        count[0]+=1
+        if count[0]>calls:
+            raise Interrupt()
+        return real(*args)
+    setattr(zw, name, Method)
+    return lambda: setattr(zw, name, real)
+
+def Device(args, seed, homeID=0xC0FFEE01, **options):
+    ''' A simulated device with args.size bytes of seeded random data in its NVM and a TestNVM connected to it.
+        The JEDEC ID matches the size so NVMSize() is args.size.'''
+    sim=SimZWave.SimZWave(size=args.size, jedec=(0xEF, 0x40, args.size.bit_length()-1), baud=0, **options)
+    sim.homeID=homeID
+    sim.flash[:]=random.Random(seed).getrandbits(8*args.size).to_bytes(args.size,"big")
+    return (sim, TestNVM.TestNVM(sim.port))
+
+def CheckDump(args, tmp):
+    ''' Dump thru every sink and load each image back'''
+    (sim, zw)=Device(args, 1)
+    try:
+        Expect(zw.DumpNVM()==sim.flash, "DumpNVM differs from the flash")
+        sim.flash[:2]=b"0x"             # a raw image that looks like the NVM.hex layout
+        for ext in (".bin", ".nvm", ".ihex", ".hex"):
+            filename=os.path.join(tmp, "dump"+ext)
+            (digest, saved)=NVMStream.Pump(zw.IterNVM(), NVMStream.Tee(NVMStream.DigestSink(), NVMStream.ImageSink(filename)))
+            Expect(NVMImage.LoadImage(filename)==sim.flash, "{} image differs from the flash".format(ext))
+            Expect(digest["bytes"]==args.size, "{} digest covers {} bytes".format(ext, digest["bytes"]))
+    finally:
+        zw.Close()
+        sim.Close()
+
+def CheckRoundTrip(args, tmp):
+    ''' Write, restore and verify - by reading back and by the chip CRC16'''
+    (sim, zw)=Device(args, 2)
+    try:
+        data=bytearray(random.Random(4).getrandbits(8*1000).to_bytes(1000,"big"))
+        Expect(zw.WriteNVM(0x1234, data), "WriteNVM failed")
+        Expect(zw.ReadNVM(0x1234, len(data))==data==sim.flash[0x1234:0x1234+len(data)], "write/read back differs")
+        image=bytearray(random.Random(5).getrandbits(8*args.size).to_bytes(args.size,"big"))
+        Expect(zw.RestoreNVM(image)[1]==args.size and sim.flash==image, "restore differs from the image")
+        Expect(zw.RestoreNVM(image)==(args.size,0,0), "restoring the same image wrote data")
+        sim.flash[args.size//3]^=0x10
+        Expect(zw.VerifyNVM(image)==1, "VerifyNVM missed the changed byte")
+        Expect(zw.VerifyCRC(image)[0]==1, "VerifyCRC missed the changed byte")
+    finally:
+        zw.Close()
+        sim.Close()
+
+def CheckLossyLink(args, tmp):
+    ''' Dump and fill over a link that NAKs and corrupts frames and loses responses'''
+    (sim, zw)=Device(args, 3, nak=0.05, corrupt=0.05)
+    try:
+        block=zw.ProbeReadBlock()
+        send=zw.Send2ZWave
+        count=[0]
+        def Lossy(*a, **k):             # every 20th response is lost
+            response=send(*a, **k)
+            count[0]+=1
+            return None if count[0]%20==0 else response
+        zw.Send2ZWave=Lossy
+        Expect(zw.DumpNVM()==sim.flash, "dump differs from the flash")
+        Expect(zw.readBlock==block, "lost responses lowered the read block to {}".format(zw.readBlock))
+        image=bytearray([0x5A])*args.size
+        Expect(zw.RestoreNVM(image)!=None and sim.flash==image, "fill differs from the image")
+    finally:
+        zw.Close()
+        sim.Close()
+
+def CheckLateResponse(args, tmp):
+    ''' Dump while one read is answered after its response timed out - the late answer must not be taken
+        for the answer to the read resent in its place'''
+    (sim, zw)=Device(args, 9)
+    try:
+        Expect(zw.DumpNVM()==sim.flash, "dump differs from the flash")     # times the responses
+        sim.late=(args.size//2, 0.8)
+        Expect(zw.DumpNVM()==sim.flash, "dump with a late response differs from the flash")
+        Expect(zw.stats.counters["late_responses"]==1, "the late response was not dropped")
+    finally:
+        zw.Close()
+        sim.Close()
+
+def CheckResume(args, tmp):
+    ''' Interrupt checkpointed dumps of two boards to the same file and a fill, then resume them'''
+    journal=os.path.join(tmp, "journal")
+    filename=os.path.join(tmp, "resume.bin")
+    (simA, a)=Device(args, 6, 0x11111111)
+    (simB, b)=Device(args, 7, 0x22222222)
+    try:
+        for (zw, calls) in ((a, 4), (b, 2)):
+            undo=InterruptAfter(zw, "ReadNVM", calls)
+            try:
+                NVMStream.Pump(NVMJournal.Dump(zw, filename, directory=journal), NVMStream.ImageSink(filename))
+                Expect(False, "the dump was not interrupted")
+            except Interrupt:
+                undo()
+        for (sim, zw) in ((simA, a), (simB, b)):
+            NVMStream.Pump(NVMJournal.Dump(zw, filename, directory=journal), NVMStream.ImageSink(filename))
+            Expect(NVMImage.LoadImage(filename)==sim.flash, "resumed dump of {} differs".format(zw.DeviceID()))
+        image=bytearray([0xA5])*args.size
+        undo=InterruptAfter(a, "RestoreNVM", 3)
+        try:
+            NVMJournal.Restore(a, image, "fill", directory=journal)
+            Expect(False, "the fill was not interrupted")
+        except Interrupt:
+            undo()
+        counts=NVMJournal.Restore(a, image, "fill", directory=journal)
+        Expect(counts!=None and counts[1]<args.size, "the fill started over")
+        Expect(simA.flash==image, "resumed fill differs from the image")
+        Expect(not os.listdir(journal), "journals left behind: {}".format(os.listdir(journal)))
+    finally:
+        for zw in (a, b):
+            zw.Close()
+        simA.Close()
+        simB.Close()
+
+def CheckCommands(args, tmp):
+    ''' The scripted commands of TestNVM.py: dump to stdout, verify the captured dump and bad or out of range arguments'''
+    (sim, zw)=Device(args, 8)
+    zw.Close()                          # the command opens the port itself
+    env=dict(os.environ, HOME=tmp)      # keep the device cache out of the real home directory
+    def Run(*argv, **kwargs):
+        return subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "TestNVM.py"),
+            sim.port]+list(argv), cwd=tmp, env=env, stderr=subprocess.PIPE, **kwargs)
+    try:
+        filename=os.path.join(tmp, "stdout.hex")
+        with open(filename, "wb") as f:
+            Expect(Run("dump", "-", stdout=f).returncode==TestNVM.EXIT_OK, "dump - failed")
+        Expect(NVMImage.LoadImage(filename)==sim.flash, "dump - differs from the flash")
+        Expect(Run("verify", filename, stdout=subprocess.PIPE).returncode==TestNVM.EXIT_OK, "verify of the dump failed")
+        end="{:X}".format(args.size-16)
+        for argv in (("read", "zz"), ("fill", "1FF"), ("write", "10", "ABC"), ("read", end, "32"), ("write", end, "00"*32),
+                     ("--no-cache",)):
+            code=Run(*argv, stdout=subprocess.PIPE).returncode
+            Expect(code==TestNVM.EXIT_USAGE, "{} exited with {}".format(" ".join(argv), code))
+    finally:
+        sim.Close()
+
+CHECKS = (("dump", CheckDump), ("round-trip", CheckRoundTrip), ("lossy-link", CheckLossyLink),
+          ("late-response", CheckLateResponse), ("resume", CheckResume), ("commands", CheckCommands))
+
+def RunChecks(args):
+    ''' Run every check in its own temporary directory and return the list of results'''
+    results=[]
+    for (name, check) in CHECKS:
+        tmp=tempfile.mkdtemp(prefix="BenchNVM-")
+        start=time.time()
+        try:
+            check(args, tmp)
+            error=None
+        except Exception as e:
+            error="{}: {}".format(type(e).__name__, e)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        results.append({"check": name, "pass": error==None, "error": error, "seconds": round(time.time()-start,3)})
+    return results
+
+if __name__ == "__main__":
+    ''' Run the benchmarks if this file is executed'''
+    parser=argparse.ArgumentParser(description="Benchmark TestNVM against a simulated SerialAPI device")
+    parser.add_argument("--baud", type=int, default=115200, help="simulated UART rate, 0=unthrottled")
+    parser.add_argument("--latency", type=float, default=0.0, help="device processing time per frame in ms")
+    parser.add_argument("--nak", type=float, default=0.0, help="probability a frame is NAKed")
+    parser.add_argument("--can", type=float, default=0.0, help="probability a frame is CANed")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="probability a response has a flipped bit")
+    parser.add_argument("--size", type=int, default=64*1024, help="bytes of NVM to dump/fill - a power of 2 of 64KB or more for --check")
+    parser.add_argument("--reads", type=int, default=200, help="number of random reads")
+    parser.add_argument("--json", help="also save the results as JSON to this file")
+    parser.add_argument("--check", action="store_true", help="run the correctness checks (unthrottled) instead of the benchmarks")
+    args=parser.parse_args()
+    TestNVM.DEBUG=1
+    if args.check:
+        TestNVM.DEBUG=0             # the lossy link check is noisy by design
+        results=RunChecks(args)
+        for r in results:
+            print("{:<14} {:<5} {:>7}s {}".format(r["check"], "PASS" if r["pass"] else "FAIL", r["seconds"], r["error"] or ""))
+    else:
+        results=RunBenchmarks(args)
+        print("{:<15} {:>8} {:>7} {:>9} {:>10} {:>10} {:>9} {:>9}  {}".format("bench", "seconds", "frames", "frames/s",
+            "bytes", "bytes/s", "p50 ms", "p99 ms", "result"))
+        for r in results:
+            print("{bench:<15} {seconds:>8} {frames:>7} {frames_per_s:>9} {bytes:>10} {bytes_per_s:>10} {rtt_p50_ms:>9} {rtt_p99_ms:>9}  ".format(**r)
+                +("PASS" if r["pass"] else "FAIL"))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    sys.exit(0 if all(r["pass"] for r in results) else 1)
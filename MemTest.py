@@ -0,0 +1,112 @@
+''' Z-Wave NVM memory test
+
+    Runs standard flash test patterns over the external NVM thru the SerialAPI of the Z-Wave chip:
+    checkerboard, inverse checkerboard, walking ones, address-in-address and a seeded pseudo-random pattern.
+    Each pattern is written to the whole NVM first and then read back, so address decoding faults show up too.
+    The read back is compared in bulk with NumPy if it is installed (pure Python otherwise) and the result
+    is a map of the bad addresses and bad bits plus the time taken by each pattern.
+
+    Progress is checkpointed in an NVMJournal so an interrupted test resumes with the chunk it stopped at.
+
+    Usage: from the TestNVM menu: t [pattern|all] [seed]
+    or as a library: MemTest.RunMemTest(TestNVM_instance, ["checkerboard"])
+'''
+
+import time
+import random
+from struct            import * # PACK
+from NVMJournal        import Journal, RunChunks
+try:
+    import numpy                # optional - only speeds up the compare
+except ImportError:
+    numpy=None
+
+PATTERNS   = ("checkerboard", "inverse", "walking1", "address", "random")
+CHUNK      = 4096       # bytes of pattern generated, written and compared at a time
+MAX_BAD    = 1000       # bad addresses listed per pattern - the counts cover all of them
+
+def Pattern(name, addr, length, seed=1):
+    ''' Return length bytes of the named pattern as it should appear starting at NVM address addr'''
+    if name=="checkerboard":            # alternating 0xAA/0x55 so every bit differs from its neighbors
+        pair=bytearray([0xAA,0x55]) if addr%2==0 else bytearray([0x55,0xAA])
+        return (pair*(length//2+1))[:length]
+    if name=="inverse":
+        pair=bytearray([0x55,0xAA]) if addr%2==0 else bytearray([0xAA,0x55])
+        return (pair*(length//2+1))[:length]
+    if name=="walking1":                # a single 1 bit that moves one position each byte
+        ring=bytearray(1<<((addr+i)%8) for i in range(8))
+        return (ring*(length//8+1))[:length]
+    if name=="address":                 # each 32 bit word holds its own address
+        first=addr&~3
+        words=b"".join(pack("!I",a) for a in range(first,addr+length,4))
+        return bytearray(words[addr-first:addr-first+length])
+    if name=="random":                  # seeded per chunk address so any range can be regenerated
+        rng=random.Random(seed*0x1000000+addr)
+        return bytearray(rng.getrandbits(8*length).to_bytes(length,"big"))
+    raise ValueError("unknown pattern {}".format(name))
+
+def Compare(addr, have, want, result):
+    ''' Compare the read back data with the pattern and add any bad addresses/bits to result'''
+    if have==want:
+        return
+    if numpy!=None:
+        diff=numpy.frombuffer(have,numpy.uint8)^numpy.frombuffer(want,numpy.uint8)
+        bad=numpy.flatnonzero(diff)
+        bits=numpy.unpackbits(diff[bad].reshape(-1,1),axis=1).sum(axis=0)[::-1]   # bit 0 first
+        for i in range(8):
+            result["bad_bits"][i]+=int(bits[i])
+        for i in bad[:max(0,MAX_BAD-len(result["bad"]))]:
+            result["bad"].append([addr+int(i), want[i], have[i]])
+        result["bad_bytes"]+=len(bad)
+        return
+    for i in range(len(want)):
+        if have[i]!=want[i]:
+            diff=have[i]^want[i]
+            for b in range(8):
+                if diff&(1<<b):
+                    result["bad_bits"][b]+=1
+            if len(result["bad"])<MAX_BAD:
+                result["bad"].append([addr+i, want[i], have[i]])
+            result["bad_bytes"]+=1
+
+def RunPattern(zw, name, size, seed=1, journal=None):
+    ''' Write the named pattern to the first size bytes of the NVM, read it all back and compare.
+        Returns a result dictionary with the counts, the bad addresses as [address, expected, actual],
+        the number of bad bits at each bit position and the write/verify times (of this run when resumed).
+        Completed chunks and the result so far are kept in journal - chunks it has as done are skipped.
+    '''
+    if journal==None:
+        journal=Journal(None, "memtest", size)
+    result=journal.data.setdefault(name, {"pattern": name, "bad_bytes": 0, "bad_bits": [0]*8, "bad": [], "error": None})
+    result["error"]=None                # a resumed run tries the chunks that failed again
+    def Write(addr, length):
+        return zw.WriteNVM(addr, Pattern(name, addr, length, seed))
+    def Verify(addr, length):
+        have=zw.ReadNVM(addr, length)
+        if have==None:
+            return False
+        Compare(addr, have, Pattern(name, addr, length, seed), result)
+        return True                     # the journal saves the result along with the chunk
+    start=time.time()
+    failed=RunChunks(journal, "write-"+name, size, Write, chunk=CHUNK)
+    if failed:
+        result["error"]="write failed at 0x{:06X}".format(failed[0][0])
+    result["write_seconds"]=round(time.time()-start,3)
+    start=time.time()
+    if result["error"]==None:
+        failed=RunChunks(journal, "verify-"+name, size, Verify, chunk=CHUNK)
+        if failed:
+            result["error"]="read failed at 0x{:06X}".format(failed[0][0])
+    result["verify_seconds"]=round(time.time()-start,3)
+    result["pass"]=result["error"]==None and result["bad_bytes"]==0
+    return result
+
+def RunMemTest(zw, patterns=PATTERNS, size=None, seed=1, journal=None):
+    ''' Run each pattern in turn over size bytes (the whole NVM by default) and return the combined machine readable verdict.
+        Progress is checkpointed in journal (an NVMJournal.Journal) when one is given.'''
+    if size==None:
+        size=zw.NVMSize()
+    start=time.time()
+    results=[RunPattern(zw, name, size, seed, journal) for name in patterns]
+    return {"size": size, "seed": seed, "pass": all(r["pass"] for r in results),
+            "seconds": round(time.time()-start,3), "numpy": numpy!=None, "patterns": results}
@@ -0,0 +1,211 @@
+''' Z-Wave NVM image files
+
+    Load and save images of the external NVM in several formats:
+    .bin    Raw image the size of the NVM, written and read thru a memory-mapped file
+    .nvm    Compact image - an index of constant runs (erased 0xFF pages etc) plus only the data that is not constant
+    .ihex   Intel HEX - records that are entirely erased (0xFF) are not written
+    .hex    The NVM.hex layout written by the TestNVM d command: lines of 0xAAAAAA=HEXDATA
+
+    LoadImage() recognizes the format from the contents of the file so a .hex file can be either Intel HEX or NVM.hex.
+    All images are returned as a bytearray with any gaps filled with 0xFF (erased flash).
+'''
+
+import os
+import mmap
+import binascii
+from struct            import * # PACK
+
+ERASED      = 0xFF      # value of erased flash
+RUN_GRANULE = 256       # constant runs are found at this granularity (one flash page)
+IHEX_RECORD = 16        # data bytes per Intel HEX record
+
+NVM_MAGIC   = b"ZNVM"
+NVM_VERSION = 1
+NVM_HEADER  = "!4sBxHII"    # magic, version, granule, image size, number of segments
+NVM_SEGMENT = "!IIH"        # start, length, fill value 0-255 or NVM_STORED
+NVM_STORED  = 0x100         # segment data is stored in the file
+
+def Segments(image, granule=RUN_GRANULE):
+    ''' Split image into a list of (start, length, fill) segments covering the whole image in order.
+        fill is the byte value of a constant run or None for data that has to be stored.
+        Adjacent granules with the same fill (or both stored) are merged into one segment.
+    '''
+    segs=[]
+    view=memoryview(image)
+    for start in range(0,len(image),granule):
+        chunk=view[start:start+granule].tobytes()
+        fill=chunk[0]
+        if chunk.count(chunk[:1])!=len(chunk):
+            fill=None
+        if segs and segs[-1][2]==fill:
+            segs[-1][1]+=len(chunk)
+        else:
+            segs.append([start,len(chunk),fill])
+    return [tuple(s) for s in segs]
+
+def SaveImage(filename, image):
+    ''' Save image in the format selected by the extension of filename (.bin, .nvm, .ihex/.ihx or NVM.hex layout)'''
+    ext=os.path.splitext(filename)[1].lower()
+    if ext==".bin":
+        SaveBin(filename, image)
+    elif ext==".nvm":
+        SaveCompact(filename, image)
+    elif ext in (".ihex", ".ihx", ".i86"):
+        SaveIntelHex(filename, image)
+    else:
+        SaveNVMHex(filename, image)
+
+def LoadImage(filename):
+    ''' Load an image saved in any of the supported formats and return it as a bytearray.
+        The extensions SaveImage uses select the format - it is only guessed from the first bytes otherwise.'''
+    ext=os.path.splitext(filename)[1].lower()
+    if ext==".bin":             # raw data can start with anything - even ":" or "0x"
+        return LoadBin(filename)
+    if ext==".nvm":
+        return LoadCompact(filename)
+    if ext in (".ihex", ".ihx", ".i86"):
+        return LoadIntelHex(filename)
+    with open(filename, "rb") as f:
+        head=f.read(len(NVM_MAGIC)).lstrip()
+    if head==NVM_MAGIC:
+        return LoadCompact(filename)
+    if head[:1]==b":":
+        return LoadIntelHex(filename)
+    if head[:2]==b"0x":
+        return LoadNVMHex(filename)
+    return LoadBin(filename)
+
+def SaveBin(filename, image):
+    ''' Write the raw image thru a memory-mapped file. Runs of 0x00 are left as holes in a fresh (sparse) file.'''
+    with open(filename, "w+b") as f:
+        f.truncate(len(image))
+        if not len(image):
+            return
+        m=mmap.mmap(f.fileno(), len(image))
+        view=memoryview(image)
+        for (start,length,fill) in Segments(image):
+            if fill!=0:
+                m[start:start+length]=view[start:start+length].tobytes()
+        m.flush()
+        m.close()
+
+def LoadBin(filename):
+    ''' Read a raw image thru a memory-mapped file'''
+    with open(filename, "rb") as f:
+        size=os.fstat(f.fileno()).st_size
+        if not size:
+            return bytearray()
+        m=mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        image=bytearray(m)
+        m.close()
+    return image
+
+def SaveCompact(filename, image):
+    ''' Write the compact format: header, segment index, then the data of the stored segments back to back'''
+    segs=Segments(image)
+    view=memoryview(image)
+    with open(filename, "wb") as f:
+        f.write(pack(NVM_HEADER, NVM_MAGIC, NVM_VERSION, RUN_GRANULE, len(image), len(segs)))
+        for (start,length,fill) in segs:
+            f.write(pack(NVM_SEGMENT, start, length, NVM_STORED if fill==None else fill))
+        for (start,length,fill) in segs:
+            if fill==None:
+                f.write(view[start:start+length].tobytes())
+
+def LoadCompact(filename):
+    ''' Read the compact format. The stored data is sliced straight out of a memory-mapped file.'''
+    with open(filename, "rb") as f:
+        m=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version, granule, size, count)=unpack_from(NVM_HEADER, m, 0)
+        if magic!=NVM_MAGIC or version!=NVM_VERSION:
+            raise ValueError("not a version {} compact NVM image".format(NVM_VERSION))
+        image=bytearray(size)
+        offset=calcsize(NVM_HEADER)
+        data=offset+count*calcsize(NVM_SEGMENT)
+        for i in range(count):
+            (start, length, fill)=unpack_from(NVM_SEGMENT, m, offset)
+            offset+=calcsize(NVM_SEGMENT)
+            if fill==NVM_STORED:
+                image[start:start+length]=m[data:data+length]
+                data+=length
+            else:
+                image[start:start+length]=bytearray([fill])*length
+    finally:
+        m.close()
+    return image
+
+def SaveIntelHex(filename, image):
+    ''' Write Intel HEX records. Records that are entirely erased are skipped since LoadIntelHex fills gaps with 0xFF.'''
+    lines=[]
+    upper=0
+    view=memoryview(image)
+    for addr in range(0,len(image),IHEX_RECORD):
+        data=view[addr:addr+IHEX_RECORD].tobytes()
+        if data.count(pack("B",ERASED))==len(data):
+            continue
+        if addr>>16!=upper:         # extended linear address record for the upper 16 bits
+            upper=addr>>16
+            lines.append(IntelHexRecord(0, 0x04, pack("!H",upper)))
+        lines.append(IntelHexRecord(addr&0xFFFF, 0x00, data))
+    lines.append(IntelHexRecord(0, 0x01, b""))
+    with open(filename, "w") as f:
+        f.write("\n".join(lines)+"\n")
+
+def IntelHexRecord(addr, rectype, data):
+    ''' Format one Intel HEX record'''
+    rec=bytearray(pack("!BHB", len(data), addr, rectype))+bytearray(data)
+    rec.append((-sum(rec))&0xFF)
+    return ":"+rec.hex().upper()
+
+def LoadIntelHex(filename):
+    ''' Read Intel HEX data (00), end (01), extended segment (02) and extended linear (04) records'''
+    image=bytearray()
+    base=0
+    with open(filename) as f:
+        for line in f:
+            line=line.strip()
+            if not line:
+                continue
+            if line[0]!=':':
+                raise ValueError("bad Intel HEX record {}".format(line))
+            rec=bytearray(binascii.unhexlify(line[1:]))
+            if sum(rec)&0xFF:
+                raise ValueError("bad Intel HEX checksum {}".format(line))
+            (length, addr, rectype)=unpack("!BHB", bytes(rec[:4]))
+            data=rec[4:4+length]
+            if rectype==0x00:
+                addr+=base
+                if addr+length>len(image):
+                    image+=bytearray([ERASED])*(addr+length-len(image))
+                image[addr:addr+length]=data
+            elif rectype==0x01:
+                break
+            elif rectype==0x02:
+                base=unpack("!H", bytes(data))[0]<<4
+            elif rectype==0x04:
+                base=unpack("!H", bytes(data))[0]<<16
+    return image
+
+def SaveNVMHex(filename, image):
+    ''' Write the NVM.hex layout of the d command - 16 bytes per line'''
+    view=memoryview(image)
+    lines=["\r\n0x{:06X}=".format(addr)+view[addr:addr+16].hex().upper()
+            for addr in range(0,len(image),16)]
+    with open(filename, "w") as f:
+        f.write("".join(lines))
+
+def LoadNVMHex(filename):
+    ''' Read a dump in the NVM.hex layout - lines of 0xAAAAAA=HEXDATA'''
+    image=bytearray()
+    with open(filename) as f:
+        for line in f:
+            line=line.strip()
+            if not line:
+                continue
+            (addr,data)=line.split('=')
+            addr=int(addr,16)
+            if addr>len(image):
+                image+=bytearray([ERASED])*(addr-len(image))  # gaps are erased flash
+            image[addr:addr+len(data)//2]=binascii.unhexlify(data)
+    return image
@@ -0,0 +1,184 @@
+''' Z-Wave NVM checkpoint journal
+
+    Dump, fill, restore and the memory test run for minutes over the SerialAPI. Each of them records the address
+    ranges it has completed in a small JSON journal per board and operation so a serial failure, ^C or crash
+    doesn't throw the work away: running the same operation on the same board again continues where it stopped.
+    Chunks that fail are recorded too and retried in a targeted pass at the end of the run.
+
+    A board is identified by its HomeID and the JEDEC ID of its NVM (TestNVM.DeviceID). The journal is removed
+    once the operation completes - delete it from JOURNAL_DIR to start an operation over from address 0.
+'''
+
+import os
+import re
+import json
+import hashlib
+
+JOURNAL_DIR = "journal"     # journals are kept here - one file per board and operation
+CHUNK       = 4096          # bytes checkpointed at a time
+RETRY_PASSES = 1            # targeted passes over the chunks that failed
+
+class Journal():
+    ''' Completed and failed ranges of each phase of one operation, saved to path after every change.
+        path=None keeps it in memory only. data is a dictionary the operation can keep its own state in.
+    '''
+    def __init__(self, path, op, size):
+        self.path=path
+        self.state={"op": op, "size": size, "phases": {}, "data": {}}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    state=json.load(f)
+                if state.get("op")==op and state.get("size")==size:
+                    self.state=state        # same operation on the same size - resume it
+            except ValueError:
+                pass                        # a journal cut off mid-write - start over
+        self.data=self.state["data"]
+
+    def Phase(self, phase):
+        return self.state["phases"].setdefault(phase, {"done": [], "failed": []})
+
+    def Completed(self):
+        ''' Bytes already done in all phases - non zero when resuming'''
+        return sum(end-start for p in self.state["phases"].values() for (start,end) in p["done"])
+
+    def IsDone(self, phase, addr, length):
+        return any(start<=addr and addr+length<=end for (start,end) in self.Phase(phase)["done"])
+
+    def Done(self, phase, addr, length):
+        p=self.Phase(phase)
+        ranges=sorted(p["done"]+[[addr,addr+length]])
+        merged=[]
+        for (start,end) in ranges:          # merge adjacent ranges so the journal stays small
+            if merged and start<=merged[-1][1]:
+                merged[-1][1]=max(merged[-1][1],end)
+            else:
+                merged.append([start,end])
+        p["done"]=merged
+        p["failed"]=[f for f in p["failed"] if f[0]!=addr]
+        self.Save()
+
+    def Failed(self, phase, addr, length):
+        p=self.Phase(phase)
+        if [addr,length] not in p["failed"]:
+            p["failed"].append([addr,length])
+        self.Save()
+
+    def FailedChunks(self, phase):
+        return [tuple(f) for f in self.Phase(phase)["failed"]]
+
+    def Save(self):
+        if not self.path:
+            return
+        tmp=self.path+".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        if os.path.exists(self.path):
+            os.remove(self.path)            # rename doesn't replace on Windows
+        os.rename(tmp, self.path)
+
+    def Finish(self):
+        ''' The operation completed - remove the journal'''
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def Path(zw, op, directory=JOURNAL_DIR):
+    ''' Filename of the journal of operation op on the board zw is connected to'''
+    name=re.sub(r'[^A-Za-z0-9.+-]+', '_', "{}_{}".format(zw.DeviceID(), op))
+    return os.path.join(directory, name+".json")
+
+def Open(zw, op, size, directory=JOURNAL_DIR):
+    ''' Return the Journal of operation op over size bytes on the board zw is connected to.
+        directory=None keeps the journal in memory only.'''
+    if directory==None:
+        return Journal(None, op, size)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    journal=Journal(Path(zw, op, directory), op, size)
+    if journal.Completed():
+        print("Resuming {} - {} bytes already done".format(op, journal.Completed()))
+    return journal
+
+def RunChunks(journal, phase, size, work, start=0, chunk=CHUNK):
+    ''' Call work(addr, length) for each chunk of size bytes from start that journal doesn't have as done.
+        work returns True when the chunk is done - False or an IOError (a SerialAPIError) marks it failed.
+        The failed chunks are then retried RETRY_PASSES more times. Returns the list of (addr, length) still failing.
+    '''
+    todo=[(addr, min(chunk,start+size-addr)) for addr in range(start,start+size,chunk)]
+    for attempt in range(1+RETRY_PASSES):
+        if attempt:
+            todo=journal.FailedChunks(phase)
+            if todo:
+                print("Retrying {} failed chunks".format(len(todo)))
+        for (addr, length) in todo:
+            if journal.IsDone(phase, addr, length):
+                continue
+            try:
+                ok=work(addr, length)
+            except IOError as e:
+                print("0x{:06X} failed - {}".format(addr, e))
+                ok=False
+            if ok:
+                journal.Done(phase, addr, length)
+            else:
+                journal.Failed(phase, addr, length)
+    return journal.FailedChunks(phase)
+
+def Restore(zw, image, op, addr=0, directory=JOURNAL_DIR):
+    ''' RestoreNVM in journaled chunks. op names the operation (such as fill) - a hash of the image is added
+        so only a rerun with the same image resumes it.
+        Returns the (skipped, written, verified) byte counts of this run or None if chunks still fail.'''
+    op="{}-{}".format(op, hashlib.sha1(bytes(image)).hexdigest()[:12])
+    journal=Open(zw, op, len(image), directory)
+    counts=[0,0,0]
+    view=memoryview(image)
+    def Work(start, length):
+        result=zw.RestoreNVM(view[start:start+length].tobytes(), addr+start)
+        if result==None:
+            return False
+        for i in range(3):
+            counts[i]+=result[i]
+        return True
+    if RunChunks(journal, "restore", len(image), Work):
+        return None
+    journal.Finish()
+    return tuple(counts)
+
+def Dump(zw, filename, length=None, directory=JOURNAL_DIR):
+    ''' Read length bytes (the whole NVM by default) into the raw file filename.DEVICEID.part, journaled so an
+        interrupted dump resumes, then yield the complete image from it in chunks for NVMStream sinks. The part file
+        is per board like the journal, which records the part file it belongs to. The part file and the journal
+        are removed after the last chunk. Raises IOError if chunks still fail.'''
+    if length==None:
+        length=zw.NVMSize()
+    part=os.path.abspath("{}.{}.part".format(filename, zw.DeviceID()))
+    op="dump-"+os.path.basename(filename)
+    intact=os.path.exists(part) and os.path.getsize(part)==length
+    path=Path(zw, op, directory) if directory!=None else None
+    if path and os.path.exists(path) and (not intact or Journal(path, op, length).data.get("part")!=part):
+        os.remove(path)             # the data read so far is gone or somewhere else - start over
+    if not intact:
+        with open(part, "wb") as f:
+            f.truncate(length)
+    journal=Open(zw, op, length, directory)
+    journal.data["part"]=part
+    with open(part, "r+b") as f:
+        def Work(addr, n):
+            data=zw.ReadNVM(addr, n)
+            if data==None:
+                return False
+            f.seek(addr)
+            f.write(bytes(data))
+            f.flush()
+            return True
+        failed=RunChunks(journal, "read", length, Work)
+    if failed:
+        raise IOError("NVM read failed at {}".format(", ".join("0x{:06X}".format(a) for (a,n) in failed)))
+    with open(part, "rb") as f:
+        while True:
+            data=f.read(CHUNK)
+            if not data:
+                break
+            yield memoryview(data)
+    os.remove(part)
+    journal.Finish()
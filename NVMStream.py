@@ -0,0 +1,226 @@
+''' Z-Wave NVM streams
+
+    Sinks for the chunks TestNVM.IterNVM yields as it reads the NVM, so an NVM of any size can be saved,
+    hashed and compared in a single pass over the UART without holding the whole image in memory:
+    BinSink       raw image
+    HexSink       the NVM.hex layout of the d command - 0xAAAAAA=HEXDATA lines of 16 bytes
+    IntelHexSink  Intel HEX - records that are entirely erased (0xFF) are not written
+    CompactSink   the .nvm compact format of NVMImage - the only one that keeps the image until Close
+    DigestSink    SHA-256 (or any hashlib algorithm) and the CRC16 the Z-Wave firmware computes
+    DiffSink      compare with a reference image and list the address ranges that differ
+    SocketSink    raw image to a TCP socket for piping to another host
+    Tee           feeds every chunk to several sinks
+    The file sinks take a filename or an open file such as sys.stdout. ImageSink picks one from a filename.
+
+    Usage: NVMStream.Pump(zw.IterNVM(), NVMStream.Tee(NVMStream.BinSink("NVM.bin"), NVMStream.DigestSink()))
+'''
+
+import os
+import sys
+import socket
+import hashlib
+import binascii
+from struct            import * # PACK
+from NVMImage          import IntelHexRecord, SaveCompact, ERASED, IHEX_RECORD
+
+HEX_RECORD = 16         # bytes per line of the NVM.hex layout
+CRC16_SEED = 0x1D0F     # initial value of the Z-Wave firmware CRC16 - same as TestNVM.CRC16
+MAX_RANGES = 1000       # differing ranges listed by DiffSink - the byte count covers all of them
+
+def Pump(chunks, sink, start=0):
+    ''' Feed the chunks (the NVM from address start) to sink and close it. Returns the result of sink.Close().
+        The sink is closed if reading a chunk fails and the exception is passed on.'''
+    addr=start
+    try:
+        for data in chunks:
+            sink.Write(addr, data)
+            addr+=len(data)
+    except Exception:
+        sink.Close()
+        raise
+    return sink.Close()
+
+def ImageSink(target):
+    ''' Return the sink for target: "-" is the NVM.hex layout on stdout, tcp:HOST:PORT a raw stream to a socket,
+        otherwise a file in the format selected by the extension like NVMImage.SaveImage'''
+    if target=="-":
+        return HexSink(sys.stdout)
+    if target.startswith("tcp:"):
+        (host, port)=target[4:].rsplit(":",1)
+        return SocketSink(host, int(port))
+    ext=os.path.splitext(target)[1].lower()
+    if ext==".bin":
+        return BinSink(target)
+    if ext==".nvm":
+        return CompactSink(target)
+    if ext in (".ihex", ".ihx", ".i86"):
+        return IntelHexSink(target)
+    return HexSink(target)
+
+class Tee():
+    ''' Write every chunk to each of the sinks. Close returns the list of their results.'''
+    def __init__(self, *sinks):
+        self.sinks=sinks
+
+    def Write(self, addr, data):
+        for sink in self.sinks:
+            sink.Write(addr, data)
+
+    def Close(self):
+        return [sink.Close() for sink in self.sinks]
+
+class FileSink():
+    ''' Base of the sinks writing to a file. target is a filename or an open file (which is flushed but left open).'''
+    def __init__(self, target, mode="wb"):
+        self.owned=not hasattr(target, "write")
+        self.f=open(target, mode) if self.owned else target
+        self.name=target if self.owned else getattr(target, "name", "")
+        self.size=0
+
+    def Write(self, addr, data):
+        self.f.write(data)
+        self.size+=len(data)
+
+    def Close(self):
+        if self.owned:
+            self.f.close()
+        else:
+            self.f.flush()
+        return {"file": self.name, "bytes": self.size}
+
+class BinSink(FileSink):
+    ''' Raw image - chunks are written as they come'''
+    pass
+
+class RecordSink(FileSink):
+    ''' Base of the text formats: chunks are cut into records of self.record bytes at multiples of self.record.
+        Any partial record is held until the rest of it arrives or Close.'''
+    record=HEX_RECORD
+
+    def __init__(self, target):
+        FileSink.__init__(self, target, "w")
+        self.pending=bytearray()
+        self.pendingAddr=0
+
+    def Write(self, addr, data):
+        if not self.pending:
+            self.pendingAddr=addr
+        self.pending+=data
+        self.size+=len(data)
+        n=len(self.pending)-len(self.pending)%self.record
+        if n:
+            self.Records(self.pendingAddr, self.pending[:n])
+            self.pendingAddr+=n
+            del self.pending[:n]
+
+    def Records(self, addr, data):
+        for i in range(0,len(data),self.record):
+            self.f.write(self.Record(addr+i, bytes(data[i:i+self.record])))
+
+    def Close(self):
+        if self.pending:
+            self.Records(self.pendingAddr, self.pending)
+        self.End()
+        return FileSink.Close(self)
+
+    def End(self):
+        pass
+
+class HexSink(RecordSink):
+    ''' The NVM.hex layout written by the d command - same as NVMImage.SaveNVMHex'''
+    def Record(self, addr, data):
+        return "\r\n0x{:06X}=".format(addr)+data.hex().upper()
+
+    def End(self):
+        if not self.owned:      # a stream such as stdout - end the last line before anything else is printed to it
+            self.f.write("\r\n")
+
+class IntelHexSink(RecordSink):
+    ''' Intel HEX like NVMImage.SaveIntelHex - erased records are skipped since LoadIntelHex fills gaps with 0xFF'''
+    record=IHEX_RECORD
+
+    def __init__(self, target):
+        RecordSink.__init__(self, target)
+        self.upper=0
+
+    def Record(self, addr, data):
+        if data.count(pack("B",ERASED))==len(data):
+            return ""
+        line=""
+        if addr>>16!=self.upper:    # extended linear address record for the upper 16 bits
+            self.upper=addr>>16
+            line=IntelHexRecord(0, 0x04, pack("!H",self.upper))+"\n"
+        return line+IntelHexRecord(addr&0xFFFF, 0x00, data)+"\n"
+
+    def End(self):
+        self.f.write(IntelHexRecord(0, 0x01, b"")+"\n")
+
+class CompactSink():
+    ''' The .nvm compact format - its segment index comes first so the image is kept until Close'''
+    def __init__(self, filename):
+        self.filename=filename
+        self.image=bytearray()
+
+    def Write(self, addr, data):
+        if addr>len(self.image):
+            self.image+=bytearray([ERASED])*(addr-len(self.image))
+        self.image[addr:addr+len(data)]=data
+
+    def Close(self):
+        SaveCompact(self.filename, self.image)
+        return {"file": self.filename, "bytes": len(self.image)}
+
+class SocketSink(FileSink):
+    ''' Raw image to a TCP connection to host:port - e.g. nc -l PORT > NVM.bin on the other host'''
+    def __init__(self, host, port):
+        self.sock=socket.create_connection((host, port))
+        FileSink.__init__(self, self.sock.makefile("wb"))
+        self.name="tcp:{}:{}".format(host, port)
+
+    def Close(self):
+        result=FileSink.Close(self)
+        self.f.close()
+        self.sock.close()
+        return result
+
+class DigestSink():
+    ''' Hash of the stream with hashlib algorithm plus the CRC-CCITT the Z-Wave firmware computes'''
+    def __init__(self, algorithm="sha256", seed=CRC16_SEED):
+        self.algorithm=algorithm
+        self.hash=hashlib.new(algorithm)
+        self.crc=seed
+        self.size=0
+
+    def Write(self, addr, data):
+        self.hash.update(data)
+        self.crc=binascii.crc_hqx(data, self.crc)
+        self.size+=len(data)
+
+    def Close(self):
+        return {self.algorithm: self.hash.hexdigest(), "crc16": "{:04X}".format(self.crc), "bytes": self.size}
+
+class DiffSink():
+    ''' Compare the stream with reference (a bytearray image - erased 0xFF past its end).
+        Close returns the number of bytes that differ and the [first, last] address ranges that differ.'''
+    def __init__(self, reference, maxRanges=MAX_RANGES):
+        self.reference=reference
+        self.maxRanges=maxRanges
+        self.bad=0
+        self.ranges=[]
+
+    def Write(self, addr, data):
+        have=bytearray(data)
+        want=bytearray(self.reference[addr:addr+len(have)])
+        want+=bytearray([ERASED])*(len(have)-len(want))
+        if have==want:
+            return
+        for i in range(len(have)):
+            if have[i]!=want[i]:
+                self.bad+=1
+                if self.ranges and self.ranges[-1][1]==addr+i-1:
+                    self.ranges[-1][1]=addr+i
+                elif len(self.ranges)<self.maxRanges:
+                    self.ranges.append([addr+i, addr+i])
+
+    def Close(self):
+        return {"bad_bytes": self.bad, "ranges": self.ranges}
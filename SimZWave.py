@@ -0,0 +1,221 @@
+''' Simulated Z-Wave 500 series SerialAPI device
+
+    Opens a pseudo terminal and answers the SerialAPI frames TestNVM uses on it, with a simulated external NVM.
+    TestNVM opens the slave side like any other serial port so the whole host side - pyserial included -
+    is exercised without a ZM5x0x. Linux/Unix only since it needs a pty.
+
+    The simulation can be slowed down and made unreliable:
+    baud        bytes are delayed as if sent over a UART at this rate in both directions (0=no throttling)
+    latency     seconds the device takes to process a frame before it answers
+    nak/can     probability of answering a frame with NAK or CAN instead of ACK (the host has to resend)
+    corrupt     probability of flipping one bit in a response frame (the host sees a checksum failure)
+    maxRead     longest NVM_EXT_READ_BUF the firmware returns in full - longer reads are truncated
+    maxWrite    longest NVM_EXT_WRITE_BUF the firmware accepts - longer writes fail
+    crc16       answer FIRMWARE_UPDATE_NVM_UPDATE_CRC16 with the CRC-CCITT of the NVM region (False=ignore it)
+    late        (address, seconds) - answer the next NVM_EXT_READ_BUF at address that many seconds late (set any time)
+
+    Usage: python3 SimZWave.py - prints the port name and runs until ^C so TestNVM.py can be pointed at it
+'''
+
+import os
+import pty
+import tty
+import time
+import random
+import binascii
+import select
+import operator
+import functools
+import threading
+from struct            import * # PACK
+
+SOF = 0x01
+ACK = 0x06
+NAK = 0x15
+CAN = 0x18
+REQUEST = 0x00
+RESPONSE = 0x01
+
+FUNC_ID_SERIAL_API_GET_INIT_DATA    = 0x02
+FUNC_ID_SERIAL_API_GET_CAPABILITIES = 0x07
+FUNC_ID_SERIAL_API_SOFT_RESET       = 0x08
+FUNC_ID_SERIAL_API_STARTED          = 0x0A
+FUNC_ID_ZW_GET_VERSION              = 0x15
+FUNC_ID_GET_HOME_ID                 = 0x20
+FUNC_ID_NVM_GET_MFG_ID              = 0x29
+FUNC_ID_NVM_EXT_READ_BUF            = 0x2A
+FUNC_ID_NVM_EXT_WRITE_BUF           = 0x2B
+FUNC_ID_NVM_EXT_WRITE_BYTE          = 0x2D
+FUNC_ID_ZW_SET_DEFAULT              = 0x42
+FUNC_ID_ZW_FIRMWARE_UPDATE_NVM      = 0x78
+FIRMWARE_UPDATE_NVM_INIT            = 0
+FIRMWARE_UPDATE_NVM_UPDATE_CRC16    = 3
+
+RESET_TIME = 0.5        # seconds from SOFT_RESET to the SERIAL_API_STARTED frame
+
+class SimZWave():
+    ''' A simulated SerialAPI device behind a pseudo terminal. self.port is the name to open.'''
+    def __init__(self, size=256*1024, jedec=(0x20,0x80,0x12), baud=115200, latency=0.0,
+                 nak=0.0, can=0.0, corrupt=0.0, maxRead=252, maxWrite=247, crc16=True, seed=1):
+        self.flash=bytearray([0xFF])*size
+        self.jedec=jedec            # manufacturer, memory type, capacity - default is a Micron M25PE20 (256KB)
+        self.baud=baud
+        self.latency=latency
+        self.nak=nak
+        self.can=can
+        self.corrupt=corrupt
+        self.maxRead=maxRead
+        self.maxWrite=maxWrite
+        self.crc16=crc16
+        self.late=None
+        self.homeID=0xC0FFEE01
+        self.nodeID=1
+        self.rng=random.Random(seed)
+        self.frames=0               # frames received from the host
+        self.naks=0                 # NAKs/CANs injected
+        self.corrupted=0            # responses corrupted
+        self.lastFrame=None         # last frame sent to the host - resent when the host NAKs it
+        self.retries=0
+        (self.master, slave)=pty.openpty()
+        tty.setraw(slave)
+        self.slave=slave
+        self.port=os.ttyname(slave)
+        self.rxbuf=bytearray()
+        self.running=True
+        self.thread=threading.Thread(target=self.Run, name="SimZWave {}".format(self.port))
+        self.thread.daemon=True
+        self.thread.start()
+
+    def Close(self):
+        self.running=False
+        self.thread.join(1)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def Wire(self, nbytes):
+        ''' Wait as long as nbytes take on the UART'''
+        if self.baud:
+            time.sleep(nbytes*10.0/self.baud)
+
+    def Send(self, data):
+        self.Wire(len(data))
+        os.write(self.master, data)
+
+    def Frame(self, payload, ftype=RESPONSE):
+        ''' Build a frame to the host'''
+        frame=bytearray([SOF, len(payload)+2, ftype])+payload
+        frame.append(functools.reduce(operator.xor, frame[1:], 0xFF))
+        return frame
+
+    def Respond(self, payload, ftype=RESPONSE):
+        self.lastFrame=self.Frame(payload, ftype)
+        self.retries=0
+        self.Transmit()
+
+    def Transmit(self):
+        ''' Send (or resend) the last frame, corrupting it now and then if asked to'''
+        frame=bytearray(self.lastFrame)
+        if self.corrupt and self.rng.random()<self.corrupt:
+            i=self.rng.randrange(3,len(frame))
+            frame[i]^=1<<self.rng.randrange(8)
+            self.corrupted+=1
+        self.Send(frame)
+
+    def Run(self):
+        while self.running:
+            (r,w,x)=select.select([self.master],[],[],0.05)
+            if not r:
+                continue
+            try:
+                data=os.read(self.master, 4096)
+            except OSError:
+                break
+            self.rxbuf+=data
+            self.Parse()
+
+    def Parse(self):
+        ''' Pull complete host frames out of rxbuf. A NAK from the host resends the last frame up to 3 times
+            like the SerialAPI does. ACK/CAN from the host and garbage are skipped.'''
+        buf=self.rxbuf
+        while buf:
+            if buf[0]==NAK and self.lastFrame!=None and self.retries<3:
+                self.retries+=1
+                self.Transmit()
+            if buf[0]!=SOF:
+                del buf[0]
+                continue
+            if len(buf)<2 or len(buf)<buf[1]+2:
+                return
+            frame=buf[:buf[1]+2]
+            del buf[:len(frame)]
+            self.Wire(len(frame))
+            self.frames+=1
+            if functools.reduce(operator.xor, frame[1:], 0xFF)!=0:
+                self.Send(bytearray([NAK]))
+                continue
+            roll=self.rng.random()
+            if roll<self.nak+self.can:
+                self.naks+=1
+                self.Send(bytearray([NAK if roll<self.nak else CAN]))
+                continue
+            self.Send(bytearray([ACK]))
+            if self.latency:
+                time.sleep(self.latency)
+            self.Handle(frame[3:-1])
+
+    def Handle(self, cmd):
+        ''' Answer one SerialAPI command (function ID and parameters)'''
+        func=cmd[0]
+        if func in (FUNC_ID_NVM_EXT_READ_BUF, FUNC_ID_NVM_EXT_WRITE_BUF):
+            (addr, length)=((cmd[1]<<16)|(cmd[2]<<8)|cmd[3], (cmd[4]<<8)|cmd[5])
+        if func==FUNC_ID_NVM_EXT_READ_BUF:
+            if self.late and self.late[0]==addr:
+                time.sleep(self.late[1])    # the frames the host sends meanwhile wait in the pty
+                self.late=None
+            length=min(length, self.maxRead)
+            self.Respond(bytearray([func])+self.flash[addr:addr+length])
+        elif func==FUNC_ID_NVM_EXT_WRITE_BUF:
+            ok=length<=self.maxWrite and addr+length<=len(self.flash)
+            if ok:
+                self.flash[addr:addr+length]=cmd[6:6+length]
+            self.Respond(bytearray([func, 1 if ok else 0]))
+        elif func==FUNC_ID_NVM_EXT_WRITE_BYTE:
+            addr=(cmd[1]<<16)|(cmd[2]<<8)|cmd[3]
+            self.flash[addr]=cmd[4]
+            self.Respond(bytearray([func, 1]))
+        elif func==FUNC_ID_NVM_GET_MFG_ID:
+            self.Respond(bytearray([func, 1])+bytearray(self.jedec))
+        elif func==FUNC_ID_SERIAL_API_GET_CAPABILITIES:
+            self.Respond(bytearray([func])+bytearray(pack("!2B3H32s", 7, 2, 0x0000, 0x0001, 0x0001, b"\xff"*32)))
+        elif func==FUNC_ID_ZW_GET_VERSION:
+            self.Respond(bytearray([func])+bytearray(b"Z-Wave 6.01\x00")+bytearray([0x07]))
+        elif func==FUNC_ID_SERIAL_API_GET_INIT_DATA:
+            nodes=bytearray(29)
+            nodes[0]=1
+            self.Respond(bytearray([func, 5, 0x08, 29])+nodes+bytearray([5, 0]))
+        elif func==FUNC_ID_GET_HOME_ID:
+            self.Respond(bytearray([func])+bytearray(pack("!IB", self.homeID, self.nodeID)))
+        elif func==FUNC_ID_ZW_FIRMWARE_UPDATE_NVM:
+            if cmd[1]==FIRMWARE_UPDATE_NVM_INIT:
+                self.Respond(bytearray([func, FIRMWARE_UPDATE_NVM_INIT, 1]))
+            elif cmd[1]==FIRMWARE_UPDATE_NVM_UPDATE_CRC16 and self.crc16:
+                (offset, length, seed)=((cmd[2]<<16)|(cmd[3]<<8)|cmd[4], (cmd[5]<<8)|cmd[6], (cmd[7]<<8)|cmd[8])
+                crc=binascii.crc_hqx(bytes(self.flash[offset:offset+length]), seed)
+                self.Respond(bytearray([func, FIRMWARE_UPDATE_NVM_UPDATE_CRC16])+bytearray(pack("!H", crc)))
+        elif func==FUNC_ID_SERIAL_API_SOFT_RESET:
+            time.sleep(RESET_TIME)
+            self.Respond(bytearray([FUNC_ID_SERIAL_API_STARTED, 0, 0, 0, 0]), REQUEST)
+        elif func==FUNC_ID_ZW_SET_DEFAULT:
+            if len(cmd)>1 and cmd[1]:
+                self.Respond(bytearray([func, cmd[1]]), REQUEST)
+        # anything else is ACKed and ignored
+
+if __name__ == "__main__":
+    ''' Run a simulated device until ^C'''
+    sim=SimZWave()
+    print("Simulated Z-Wave SerialAPI device on {} - run: python3 TestNVM.py {}".format(sim.port, sim.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.Close()
@@ -6,9 +6,11 @@
     This program is a DEMO only and is provided AS-IS and without support. 
     But feel free to copy and improve!
 
-    Usage: python TestNVM.py [COMx]
+    Usage: python3 TestNVM.py [COMx]                    interactive menu
+           python3 TestNVM.py [COMx] COMMAND [ARGS]     run one of probe, dump, fill, restore, verify, read, write
+                                                        or reset and print the result as JSON (-h for the details)
     COMx is optional and is the COM port or /dev/tty* port of the Z-Wave interface.
-    Tested using Python 2.7 - untested on Python 3
+    Requires Python 3.8 or newer - frames are handled as bytes/bytearray/memoryview thruout
 
    References:
    SerialAPI: https://www.silabs.com/documents/login/user-guides/INS12350-Serial-API-Host-Appl.-Prg.-Guide.pdf (or search "SerialAPI" on the silabs site)
@@ -19,21 +21,40 @@
 
 import serial           # serial port control
 import sys
+import re
+import argparse
 import time
 import os
+import json
+import random
+import bisect
+import binascii
+import threading
+import atexit
+import queue
+import operator
+import functools
+import collections
 from struct            import * # PACK
+from NVMImage          import LoadImage
+import MemTest
+import NVMStream
+import NVMJournal
 
 
 COMPORT       = "/dev/ttyAMA0" # Serial port default on a Raspberry Pi
 
 VERSION       = "1.0 - 3/18/2019"       # Version of this python program
 DEBUG         = 4     # (0-10) higher values print out more debugging info - 0=off
+METRICS_FILE  = "metrics.json"  # transport metrics are saved here when the program exits
+DEVICE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".TestNVM")  # device info cached per port by the scripted commands
 
 # Handy defines mostly copied from ZW_transport_api.py
 FUNC_ID_SERIAL_API_GET_INIT_DATA    = 0x02
 FUNC_ID_SERIAL_API_APPL_NODE_INFORMATION = 0x03
 FUNC_ID_SERIAL_API_GET_CAPABILITIES = 0x07
 FUNC_ID_SERIAL_API_SOFT_RESET       = 0x08
+FUNC_ID_SERIAL_API_STARTED          = 0x0A
 FUNC_ID_ZW_GET_PROTOCOL_VERSION     = 0x09
 FUNC_ID_ZW_SEND_DATA                = 0x13
 FUNC_ID_ZW_GET_VERSION              = 0x15
@@ -46,6 +67,7 @@ FUNC_ID_ZW_SET_DEFAULT              = 0x42
 FUNC_ID_ZW_ADD_NODE_TO_NETWORK      = 0x4A
 FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK = 0x4B
 FUNC_ID_ZW_FIRMWARE_UPDATE_NVM      = 0x78
+FUNC_NAMES = dict((v,k[8:]) for (k,v) in globals().items() if k.startswith("FUNC_ID_")) # for printing metrics
 
 # Firmware Update NVM commands
 FIRMWARE_UPDATE_NVM_INIT            = 0
@@ -99,6 +121,16 @@ ADD_NODE_STATUS_PROTOCOL_DONE        = 5
 ADD_NODE_STATUS_DONE                 = 6
 ADD_NODE_STATUS_FAILED               = 7
 ADD_NODE_STATUS_NOT_PRIMARY          = 0x23
+REMOVE_NODE_ANY                      = 0x01
+REMOVE_NODE_CONTROLLER               = 0x02
+REMOVE_NODE_SLAVE                    = 0x03
+REMOVE_NODE_STOP                     = 0x05
+REMOVE_NODE_STATUS_LEARN_READY       = 1
+REMOVE_NODE_STATUS_NODE_FOUND        = 2
+REMOVE_NODE_STATUS_REMOVING_SLAVE    = 3
+REMOVE_NODE_STATUS_REMOVING_CONTROLLER = 4
+REMOVE_NODE_STATUS_DONE              = 6
+REMOVE_NODE_STATUS_FAILED            = 7
 
 # SerialAPI defines
 SOF = 0x01
@@ -107,9 +139,70 @@ NAK = 0x15
 CAN = 0x18
 REQUEST = 0x00
 RESPONSE = 0x01
+ACK_BYTE = bytes([ACK])
+NAK_BYTE = bytes([NAK])
+MAX_FRAME = 255+2     # SOF + LEN + up to 255 bytes counted by LEN
+
+# Precompiled layouts of the SerialAPI frames - responses and callbacks start with the function ID
+FRAME_HEADER     = Struct("BBB")        # SOF, LEN, TYPE
+NVM_CMD          = Struct("!BBHH")      # NVM_EXT_READ_BUF/WRITE_BUF request: function ID, 24 bit address (high byte, low word), length
+NVM_WRITE_BYTE   = Struct("!BBHB")      # NVM_EXT_WRITE_BYTE request: function ID, 24 bit address, data
+CRC16_CMD        = Struct("!BBBHHH")    # FIRMWARE_UPDATE_NVM_UPDATE_CRC16 request: function ID, subcommand, 24 bit address, length, seed
+CRC16_RES        = Struct("!BBH")       # its response: function ID, subcommand, CRC16
+HOME_ID_RES      = Struct("!BIB")       # GET_HOME_ID response: function ID, HomeID, NodeID
+CAPABILITIES_RES = Struct("!BBB3H32s")  # SERIAL_API_GET_CAPABILITIES response: function ID, version, revision, mfg, product type, product ID, function bitmask
+VERSION_RES      = Struct("!B12sB")     # ZW_GET_VERSION response: function ID, NUL terminated version string, library type
+STATUS_CB        = Struct("BBB")        # ADD/REMOVE_NODE and SEND_DATA callbacks: function ID, callback ID, status
+NVM_READ_SIZES = (252, 128, 64, 32, 16) # NVM_EXT_READ_BUF lengths to try, largest first. 252 fills a maximum length response frame
+NVM_WRITE_SIZES = (247, 128, 64, 32, 16) # NVM_EXT_WRITE_BUF lengths to try, largest first. 247 fills a maximum length request frame
+NVM_COMPARE_SIZE = 16   # granularity at which restore compares the NVM against the image
+NVM_PROBE_TIMEOUT = 500 # ms to wait for a response while probing for the largest block
+NVM_BLOCK_RETRIES = 1   # times a block that got no response is resent at the same size before a smaller one is tried
+RESET_TIMEOUT = 3000    # ms to wait for the SERIAL_API_STARTED frame after a soft reset
+NVM_DUMP_CHUNK = 4096  # bytes handed to ReadNVM per call while dumping - also the chunk size of IterNVM
+READER_POLL = 0.02      # seconds the reader thread blocks in each read - also how long Close waits for it
+RX_CHAR_TIMEOUT = 0.150 # SerialAPI inter-byte timeout - a partial frame older than this is dropped and the receiver resyncs on the next SOF
+ACK_TIMEOUT_MIN = 0.1   # seconds - floor of the adaptive ACK timeout - a late ACK means the chip gets the frame twice
+ACK_TIMEOUT_MAX = 1.6   # seconds - SerialAPI ACK timeout - used until the ACKs of a function ID have been timed
+RESPONSE_TIMEOUT_MIN = 0.5  # seconds - floor of the adaptive response timeout - a response later than that is dropped (see SerialAPITransport.Stale)
+RESPONSE_TIMEOUT_MAX = 5.0  # seconds - used until the responses of a function ID have been timed - a response later than that is taken as lost
+RTT_K = 4               # adaptive timeouts are the smoothed round trip time plus RTT_K times its mean deviation
+RTT_SAMPLES = 4         # round trips timed before the adaptive timeout of a function ID is used
+MAX_RETRANSMIT = 3      # SerialAPI limit on retransmissions of one frame
+BACKOFF_BASE = 0.025    # seconds before the first retransmission (about one maximum length frame at 115200) - doubles each time
+RETRY_BUDGET = 20       # retransmissions allowed in a burst before SerialAPIError is raised
+RETRY_RATIO = 0.2       # retransmissions earned back by each frame ACKed the first time
+CACHE_PAGES = 64        # NVM pages kept in the page cache used by the r command - least recently used are dropped
+CACHE_READ_AHEAD = 4    # extra pages fetched when reads walk forward thru the NVM - 0=off
+CRC16_SEED = 0x1D0F     # initial value of the CRC-CCITT the Z-Wave firmware computes (same as ZW_CheckCrc16)
+CRC16_REGION = 32768    # bytes per FIRMWARE_UPDATE_NVM_UPDATE_CRC16 request when verifying - the length is 16 bits
+CRC16_LEAF = 1024       # regions whose CRC differs are bisected down to this size and then read back
+CRC16_TIMEOUT = 5000    # ms to wait for a CRC16 - the chip reads the whole region out of the NVM first
+CRC16_PROBE_PAGES = 16  # pages searched for data that isn't all one value to check the chip CRC16 against
 # Most Z-Wave commands want the autoroute option on to be sure it gets thru. Don't use Explorer though as that causes unnecessary delays.
 TXOPTS = TRANSMIT_OPTION_AUTO_ROUTE | TRANSMIT_OPTION_ACK
 
+# External NVM identification from the JEDEC ID returned by FUNC_ID_NVM_GET_MFG_ID - see DecodeJEDEC()
+NVM_DEFAULT_SIZE = 256*1024 # assumed when the part isn't recognized - 2Mbit is the 500 series reference design
+NVM_PAGE         = 256      # program page of nearly every serial flash
+NVM_SECTOR       = 4096     # smallest erase block of most serial flash
+JEDEC_MFG = {
+0x01 : "Cypress/Spansion",
+0x1C : "EON",
+0x1F : "Adesto/Atmel",
+0x20 : "Micron",
+0x62 : "ON Semi",
+0x85 : "Puya",
+0x9D : "ISSI",
+0xC2 : "Macronix",
+0xC8 : "GigaDevice",
+0xEF : "Winbond" }
+JEDEC_GEOMETRY = {              # (mfg, memory type) : (page, sector) for the families that differ from NVM_PAGE/NVM_SECTOR
+(0x20, 0x20) : (256, 65536),    # Micron M25P - sector erase only
+(0x20, 0x80) : (256, 256),      # Micron M25PE - page erase
+(0x01, 0x02) : (256, 65536),    # Spansion S25FL
+(0x01, 0x40) : (256, 65536) }   # Spansion S25FL1
+
 # See INS13954-7 section 7 Application Note: Z-Wave Protocol Versions on page 433
 ZWAVE_VER_DECODE = {# Z-Wave version to SDK decoder: https://www.silabs.com/products/development-tools/software/z-wave/embedded-sdk/previous-versions
         "6.01" : "SDK 6.81.00 09/2017",
@@ -136,329 +229,1467 @@ ZWAVE_VER_DECODE = {# Z-Wave version to SDK decoder: https://www.silabs.com/prod
         "3.37" : "SDK 6.01.03        "
         }
 
+def DecodeJEDEC(jedec):
+    ''' Decode the 3 JEDEC ID bytes (manufacturer, memory type, capacity) of the external NVM.
+        Returns a dictionary with the jedec string, mfg name, size, page and sector size in bytes.
+        known is False when the size could not be decoded and NVM_DEFAULT_SIZE is assumed.
+    '''
+    (mfg, memtype, capacity)=jedec
+    size=None
+    if mfg==0x1F:                   # Adesto/Atmel: density code in the low 5 bits of the memory type 3=2Mbit
+        if 1<=(memtype&0x1F)<=8:
+            size=(32*1024)<<(memtype&0x1F)
+    elif 0x10<=capacity<=0x18:      # everybody else: capacity is log2 of the size 0x12=256KB - the 24 bit NVM address tops out at 16MB
+        size=1<<capacity
+    (page, sector)=JEDEC_GEOMETRY.get((mfg,memtype), (NVM_PAGE, NVM_SECTOR))
+    return {"jedec": "{:02X} {:02X} {:02X}".format(mfg, memtype, capacity), "mfg": JEDEC_MFG.get(mfg, "Unknown"),
+            "size": size or NVM_DEFAULT_SIZE, "page": page, "sector": sector, "known": size!=None}
+
+def Checksum(frame):
+    ''' SerialAPI checksum - 0xFF XOR every byte from LEN up to the checksum. A whole frame after the SOF gives 0.'''
+    return functools.reduce(operator.xor, frame, 0xFF)
+
+def CRC16(data, crc=CRC16_SEED):
+    ''' CRC-CCITT (polynomial 0x1021, not reflected) of data - the CRC16 FIRMWARE_UPDATE_NVM_UPDATE_CRC16 returns'''
+    return binascii.crc_hqx(bytes(data), crc)
+
+class SerialAPIError(IOError):
+    ''' A frame could not be delivered to the Z-Wave chip within the limits of the RetryPolicy'''
+    def __init__(self, message, funcID=None):
+        IOError.__init__(self, message)
+        self.funcID=funcID
+
+class RetryPolicy():
+    ''' Timeouts and retransmissions for the SerialAPI transport.
+        The round trip times of the ACK and of the response are tracked per function ID with the smoothed
+        mean and mean deviation estimator TCP uses. Each timeout is the mean plus k deviations within fixed limits.
+        A frame is resent at most maxRetransmit times with a short exponential backoff. Retransmissions also
+        come out of a budget shared by all frames: each one spends 1 and each frame ACKed the first time
+        earns back ratio. An occasional NAK on a noisy fixture is absorbed while a link that fails most
+        frames raises SerialAPIError instead of limping on.
+    '''
+    def __init__(self, k=RTT_K, maxRetransmit=MAX_RETRANSMIT, budget=RETRY_BUDGET, ratio=RETRY_RATIO, backoff=BACKOFF_BASE):
+        self.k=k
+        self.maxRetransmit=maxRetransmit
+        self.budget=budget
+        self.ratio=ratio
+        self.backoff=backoff
+        self.tokens=float(budget)
+        self.rtt={}             # (function ID, "ack"|"response") -> [smoothed RTT, mean deviation, samples] in seconds
+        self.rng=random.Random()
+
+    def Sample(self, funcID, kind, seconds):
+        ''' Add a measured round trip time'''
+        est=self.rtt.get((funcID,kind))
+        if est==None:
+            self.rtt[(funcID,kind)]=[seconds, seconds/2, 1]
+            return
+        err=seconds-est[0]
+        est[0]+=err/8.0
+        est[1]+=(abs(err)-est[1])/4.0
+        est[2]+=1
+
+    def Timeout(self, funcID, kind, attempt=0):
+        ''' Seconds to wait for the ACK or response of funcID. Doubled on each retransmission up to the maximum.'''
+        (low, high)=(ACK_TIMEOUT_MIN, ACK_TIMEOUT_MAX) if kind=="ack" else (RESPONSE_TIMEOUT_MIN, RESPONSE_TIMEOUT_MAX)
+        est=self.rtt.get((funcID,kind))
+        if est==None or est[2]<RTT_SAMPLES:
+            return high
+        return min(high, max(low, est[0]+self.k*est[1])*(2**attempt))
+
+    def Acked(self, attempt):
+        if attempt==0:
+            self.tokens=min(self.budget, self.tokens+self.ratio)
+
+    def Retransmit(self, funcID, attempt, reason):
+        ''' Called before retransmission attempt (1, 2...) of a frame for funcID that was not ACKed for reason.
+            Returns the seconds to back off before resending or raises SerialAPIError if no more retries are allowed.
+        '''
+        if attempt>self.maxRetransmit:
+            raise SerialAPIError("function 0x{:02X} {} after {} retransmissions".format(funcID, reason, self.maxRetransmit), funcID)
+        if self.tokens<1:
+            raise SerialAPIError("function 0x{:02X} {} - retry budget exhausted".format(funcID, reason), funcID)
+        self.tokens-=1
+        return self.backoff*(2**(attempt-1))*self.rng.uniform(1.0,1.5)    # jitter so a CAN doesn't repeat in lockstep
+
+class Histogram():
+    ''' Latency histogram in milliseconds with fixed buckets'''
+    BOUNDS=(0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counts=[0]*(len(self.BOUNDS)+1)    # last bucket is everything over 5 seconds
+        self.n=0
+        self.total=0.0
+        self.max=0.0
+
+    def Add(self, ms):
+        self.counts[bisect.bisect_left(self.BOUNDS, ms)]+=1
+        self.n+=1
+        self.total+=ms
+        self.max=max(self.max, ms)
+
+    def Percentile(self, p):
+        ''' Upper bound of the bucket holding the p (0-1) percentile'''
+        target=p*self.n
+        seen=0
+        for (i,count) in enumerate(self.counts):
+            seen+=count
+            if count and seen>=target:
+                return self.BOUNDS[i] if i<len(self.BOUNDS) else self.max
+        return 0
+
+    def Summary(self):
+        labels=["<={}".format(b) for b in self.BOUNDS]+[">{}".format(self.BOUNDS[-1])]
+        return {"count": self.n, "mean": round(self.total/self.n,3) if self.n else 0, "max": round(self.max,3),
+                "p50": self.Percentile(0.5), "p99": self.Percentile(0.99),
+                "buckets": dict((label,c) for (label,c) in zip(labels,self.counts) if c)}
+
+class TransportStats():
+    ''' Counters and per function ID latency histograms for the SerialAPI transport.
+        Latencies are request to ACK ("ack") and request to response ("response").
+        Updated from both the reader thread and the thread sending requests.
+    '''
+    COUNTERS=("frames_sent", "frames_received", "retries", "naks", "cans", "ack_timeouts", "response_timeouts",
+              "late_responses", "checksum_errors", "resync_bytes", "partial_frames")
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self.lock:
+            self.counters=dict((name,0) for name in self.COUNTERS)
+            self.latency={}         # (function ID, "ack"|"response") -> Histogram
+            self.start=time.time()
+
+    def Count(self, name, n=1):
+        with self.lock:
+            self.counters[name]+=n
+
+    def Latency(self, funcID, kind, seconds):
+        with self.lock:
+            if (funcID,kind) not in self.latency:
+                self.latency[(funcID,kind)]=Histogram()
+            self.latency[(funcID,kind)].Add(seconds*1000.0)
+
+    def Snapshot(self):
+        ''' Return everything as a dictionary ready for json.dump'''
+        with self.lock:
+            functions={}
+            for ((funcID,kind),hist) in sorted(self.latency.items()):
+                name="0x{:02X} {}".format(funcID, FUNC_NAMES.get(funcID,""))
+                functions.setdefault(name,{})[kind+"_ms"]=hist.Summary()
+            return {"seconds": round(time.time()-self.start,3), "counters": dict(self.counters), "functions": functions}
+
+    def Print(self):
+        snap=self.Snapshot()
+        print("Transport metrics over {}s".format(snap["seconds"]))
+        print("  " + " ".join("{}={}".format(k,snap["counters"][k]) for k in self.COUNTERS))
+        for (name,kinds) in sorted(snap["functions"].items()):
+            for kind in sorted(kinds):
+                h=kinds[kind]
+                print("  {:<34} {:<11} n={:<6} mean={:<8} p50<={:<6} p99<={:<6} max={}".format(name, kind, h["count"],
+                    h["mean"], h["p50"], h["p99"], h["max"]))
+
+class FrameReceiver():
+    ''' Incremental SerialAPI frame receiver.
+        Bytes are pulled from the UART with blocking bulk reads (whatever has arrived, at least 1 byte) and
+        fed thru a SOF/LEN/TYPE/DATA/CHECKSUM state machine. Each ACK/NAK/CAN and each completed frame is
+        passed to deliver(kind, frame) in the order they arrived. A partial frame stays in the state machine
+        so bytes that arrive early are never thrown away. A frame with a bad checksum is NAKed and dropped -
+        the chip resends it.
+    '''
+    ST_SOF, ST_LEN, ST_TYPE, ST_DATA, ST_CHK = range(5)
+
+    def __init__(self, port, deliver, stats):
+        self.port=port
+        self.deliver=deliver    # called with (ACK|NAK|CAN, None) or (SOF, frame)
+        self.stats=stats
+        self.state=self.ST_SOF
+        self.frame=bytearray()  # LEN, TYPE, CMD, data... of the frame being received
+        self.remaining=0        # data bytes still to come before the checksum
+        self.lastrx=0.0
+        self.timeout=None       # last timeout set on the port - only reconfigure the UART when it changes
+
+    def Feed(self, data):
+        ''' Run the bytes in data thru the state machine. Good frames are ACKed and delivered, bad ones NAKed.'''
+        now=time.time()
+        if self.state!=self.ST_SOF and now-self.lastrx>RX_CHAR_TIMEOUT:
+            if DEBUG>1: print("GetZWave partial frame timed out - resync")
+            self.stats.Count("partial_frames")
+            self.state=self.ST_SOF
+        self.lastrx=now
+        i=0
+        while i<len(data):
+            c=data[i]
+            if self.state==self.ST_DATA:    # copy as much of the payload as is available in one slice
+                n=min(self.remaining,len(data)-i)
+                self.frame+=data[i:i+n]
+                self.remaining-=n
+                i+=n
+                if self.remaining==0:
+                    self.state=self.ST_CHK
+                continue
+            i+=1
+            if self.state==self.ST_SOF:
+                if c==SOF:
+                    self.frame=bytearray()
+                    self.state=self.ST_LEN
+                elif c==ACK or c==NAK or c==CAN:
+                    self.deliver(c,None)
+                else:
+                    self.stats.Count("resync_bytes")
+                    if DEBUG>5: print("SerialAPI Not SYNCed {:02X}".format(c))
+            elif self.state==self.ST_LEN:
+                if c<3:                     # shortest legal frame is TYPE, CMD, CHECKSUM
+                    if DEBUG>5: print("SerialAPI bad length {:02X}".format(c))
+                    self.stats.Count("resync_bytes",2)
+                    self.state=self.ST_SOF
+                    continue
+                self.frame.append(c)
+                self.remaining=c-2          # LEN counts TYPE and CHECKSUM
+                self.state=self.ST_TYPE
+            elif self.state==self.ST_TYPE:
+                self.frame.append(c)
+                self.state=self.ST_DATA
+            else:                           # ST_CHK
+                self.frame.append(c)
+                self.state=self.ST_SOF
+                checksum=Checksum(self.frame)
+                self.stats.Count("frames_received")
+                if checksum!=0:
+                    if DEBUG>1: print("GetZWave checksum failed {:02x}".format(checksum))
+                    self.stats.Count("checksum_errors")
+                    self.port.write(NAK_BYTE)  # the chip resends the frame
+                    continue
+                self.port.write(ACK_BYTE)
+                self.deliver(SOF,bytes(self.frame))
+
+    def Poll(self, timeout):
+        ''' Block for up to timeout seconds until at least one byte arrives then feed everything waiting.'''
+        if timeout!=self.timeout:
+            self.port.timeout=timeout
+            self.timeout=timeout
+        data=self.port.read(max(1,self.port.inWaiting()))
+        if data:
+            self.Feed(data)
+
+class Waiter():
+    ''' Queue of frames routed to one consumer by the SerialAPITransport reader thread.
+        A timed Queue.get blocks on a lock and wakes up as soon as a frame is put.
+    '''
+    def __init__(self):
+        self.q=queue.Queue()
+
+    def Put(self, pkt):
+        self.q.put(pkt)
+
+    def Get(self, timeout=5000):
+        ''' Return the next frame or None after timeout ms'''
+        try:
+            return self.q.get(timeout=timeout/1000.0)
+        except queue.Empty:
+            return None
+
+    def Clear(self):
+        try:
+            while True:
+                self.q.get_nowait()
+        except queue.Empty:
+            pass
+
+class SerialAPITransport():
+    ''' Reads and routes SerialAPI frames from a background reader thread.
+        The reader thread is the only one that reads the UART. It parses frames continuously and routes them:
+        - ACK/NAK/CAN go to the ACK queue used by Send2ZWave
+        - REQUEST frames carrying a registered callback funcID (such as the 0xaa/0xdd used for inclusion/exclusion)
+          go to the Waiter returned by Callback()
+        - RESPONSE frames (or a REQUEST callback nobody registered for) go to the outstanding request for
+          the same function ID registered with Expect()
+        - the first such frame after a request for the function ID timed out is the late answer to that request
+          and is dropped - see Stale()
+        - everything else is unsolicited and goes to each subscriber and to the queue read by GetZWave
+        Frames carry the command byte onward - the length, type and checksum are stripped off.
+        A thread rather than an asyncio reader task: pyserial has no asyncio support of its own (pyserial-asyncio
+        is another package and a Windows COM port can't be added to an event loop) and every caller - the menu,
+        the scripted commands, TestStation, MemTest, NVMJournal and NVMStream - is blocking code that would need
+        a thread to drive an event loop anyway. The reader blocks in the UART read and wakes as soon as a byte
+        arrives so the thread costs no polling. One per port is fine for the dozens of ports of a test rack.
+    '''
+    def __init__(self, port):
+        self.port=port
+        self.stats=TransportStats()
+        self.rx=FrameReceiver(port,self.Route,self.stats)
+        self.lock=threading.Lock()  # protects the routing tables below
+        self.acks=Waiter()
+        self.unsolicited=Waiter()
+        self.pending={}             # function ID -> Waiter for the outstanding request
+        self.callbacks={}           # (function ID, callback funcID) -> Waiter
+        self.stale={}               # function ID -> (deadline, Event) of a request whose response timed out
+        self.subscribers=[]
+        self.running=True
+        self.reader=threading.Thread(target=self.Reader, name="SerialAPI reader {}".format(getattr(port,"port","")))
+        self.reader.daemon=True
+        self.reader.start()
+
+    def Reader(self):
+        while self.running:
+            try:
+                self.rx.Poll(READER_POLL)
+            except (serial.SerialException, OSError, ValueError) as e:   # port closed or unplugged
+                if self.running and DEBUG>1: print("SerialAPI reader stopped - {}".format(e))
+                break
+        self.running=False
+
+    def Close(self):
+        ''' Stop the reader thread'''
+        self.running=False
+        if self.reader!=threading.current_thread():
+            self.reader.join(2*READER_POLL)
+
+    def Route(self, kind, frame):
+        if kind!=SOF:
+            self.acks.Put(kind)
+            return
+        (ftype,pkt)=(frame[1],frame[2:-1])
+        cmd=pkt[0]
+        with self.lock:
+            waiter=None
+            if ftype==REQUEST and len(pkt)>1:
+                waiter=self.callbacks.get((cmd,pkt[1]))
+            late=None
+            if waiter==None and cmd in self.stale:
+                late=self.stale.pop(cmd)
+                if late[0]<time.time():     # too late to be the lost response - route it as usual
+                    late=None
+            if waiter==None and late==None:
+                waiter=self.pending.get(cmd)
+            subscribers=list(self.subscribers)
+        if late!=None:
+            if DEBUG>1: print("Dropped the late response to function 0x{:02X}".format(cmd))
+            self.stats.Count("late_responses")
+            late[1].set()
+            return
+        if waiter!=None:
+            waiter.Put(pkt)
+            return
+        for func in subscribers:
+            func(ftype,pkt)
+        self.unsolicited.Put(pkt)
+
+    def Expect(self, funcID):
+        ''' Register the request about to be sent and return the Waiter its response will be routed to'''
+        waiter=Waiter()
+        with self.lock:
+            self.pending[funcID]=waiter
+        return waiter
+
+    def Done(self, funcID):
+        with self.lock:
+            self.pending.pop(funcID,None)
+
+    def Stale(self, funcID, sent):
+        ''' The response to the funcID request sent at time sent timed out. Responses carry no more than the
+            function ID (an NVM_EXT_READ_BUF response has no address) so a late one would be taken for the answer
+            to the next funcID request. The next response for funcID until RESPONSE_TIMEOUT_MAX after sent is dropped.'''
+        with self.lock:
+            self.stale[funcID]=(sent+RESPONSE_TIMEOUT_MAX, threading.Event())
+
+    def Settle(self, funcID):
+        ''' Wait before a new funcID request until the late response of a timed out one has been dropped or
+            RESPONSE_TIMEOUT_MAX has passed - whatever comes after that is the answer to the new request'''
+        with self.lock:
+            late=self.stale.get(funcID)
+        if late==None:
+            return
+        late[1].wait(max(0.0,late[0]-time.time()))
+        with self.lock:
+            if self.stale.get(funcID) is late:
+                del self.stale[funcID]
+
+    def Callback(self, funcID, callbackID):
+        ''' Route callback REQUEST frames for funcID carrying callbackID to the returned Waiter until Release()'''
+        waiter=Waiter()
+        with self.lock:
+            self.callbacks[(funcID,callbackID)]=waiter
+        return waiter
+
+    def Release(self, funcID, callbackID):
+        with self.lock:
+            self.callbacks.pop((funcID,callbackID),None)
+
+    def Subscribe(self, func):
+        ''' Call func(type, pkt) from the reader thread for every unsolicited frame'''
+        with self.lock:
+            self.subscribers.append(func)
+
+    def Unsubscribe(self, func):
+        with self.lock:
+            self.subscribers.remove(func)
+
+    def Purge(self):
+        ''' Drop ACKs and unsolicited frames from before a new request. A partially received frame is kept.'''
+        self.acks.Clear()
+        self.unsolicited.Clear()
+
+class NVMCache():
+    ''' LRU cache of NVM pages for interactive reads (the r command).
+        Missing pages are fetched in one read of the whole run so they come in the largest blocks the firmware
+        accepts, and when the reads walk forward thru the NVM the next readAhead pages come along with them.
+        Writes made thru TestNVM update the pages already cached. Anything else that may change the NVM
+        (the w command, soft reset, SetDefault, inclusion/exclusion) has to Invalidate or Clear the cache.
+    '''
+    def __init__(self, read, page=NVM_PAGE, pages=CACHE_PAGES, readAhead=CACHE_READ_AHEAD):
+        self.read=read          # read(addr, length) returning a bytearray or None - TestNVM.ReadNVM
+        self.page=page
+        self.pages=pages
+        self.readAhead=readAhead
+        self.cache=collections.OrderedDict()    # page number -> bytearray, least recently used first
+        self.last=None          # last page read - to spot sequential reads
+        self.hits=0
+        self.misses=0
+
+    def Read(self, addr, length, size=None):
+        ''' Return length bytes starting at addr from the cache, fetching any missing pages.
+            Read ahead stops at size (the end of the NVM). Returns a bytearray or None if a read failed.'''
+        first=addr//self.page
+        last=(addr+length-1)//self.page
+        missing=[p for p in range(first,last+1) if p not in self.cache]
+        self.hits+=last-first+1-len(missing)
+        self.misses+=len(missing)
+        if missing:
+            end=missing[-1]
+            if self.readAhead and self.last!=None and self.last<=first<=self.last+1:
+                end+=self.readAhead
+                if size:
+                    end=max(missing[-1],min(end,(size-1)//self.page))
+            data=self.read(missing[0]*self.page,(end-missing[0]+1)*self.page)
+            if data==None:
+                return None
+            for p in range(missing[0],end+1):
+                i=(p-missing[0])*self.page
+                self.cache.pop(p,None)
+                self.cache[p]=data[i:i+self.page]
+        self.last=last
+        buf=bytearray()
+        for p in range(first,last+1):
+            self.cache[p]=self.cache.pop(p)     # most recently used now
+            buf+=self.cache[p]
+        while len(self.cache)>self.pages:
+            self.cache.popitem(last=False)
+        i=addr-first*self.page
+        return buf[i:i+length]
+
+    def Update(self, addr, data):
+        ''' Copy data just written at addr into any cached pages it overlaps'''
+        data=bytearray(data)
+        for p in range(addr//self.page,(addr+len(data)-1)//self.page+1):
+            if p in self.cache:
+                start=max(addr,p*self.page)
+                end=min(addr+len(data),(p+1)*self.page)
+                self.cache[p][start-p*self.page:end-p*self.page]=data[start-addr:end-addr]
+
+    def Invalidate(self, addr, length=1):
+        for p in range(addr//self.page,(addr+length-1)//self.page+1):
+            self.cache.pop(p,None)
+
+    def Clear(self):
+        self.cache.clear()
+        self.last=None
+
+class FrameEncoder():
+    ''' Builds SerialAPI REQUEST frames in a single preallocated buffer.
+        The frame is assembled once as SOF+LEN+TYPE+command+data+CHECKSUM and handed to the UART in one write.
+        The same buffer is resent as-is for any retransmits.
+    '''
+    def __init__(self):
+        self.buf=bytearray(MAX_FRAME)
+        self.view=memoryview(self.buf)
+
+    def Encode(self, cmd, data=None):
+        ''' Encode the SerialAPI command (function ID + parameters) and optional data and return a memoryview of the frame'''
+        start=3+len(cmd)
+        end=start+(len(data) if data else 0)
+        if end>MAX_FRAME-1:     # checked first - the buffer can't grow while self.view is exported
+            raise ValueError("SerialAPI frame too long ({} bytes)".format(end+1))
+        buf=self.buf
+        buf[3:start]=cmd
+        if data:
+            buf[start:end]=data
+        FRAME_HEADER.pack_into(buf, 0, SOF, end-1, REQUEST)    # LEN counts itself, TYPE, command, data and the checksum
+        buf[end]=Checksum(self.view[1:end])
+        return self.view[:end+1]
+
 class TestNVM():
     ''' Open the serial port to the Z-Wave SerialAPI controller '''
-    def __init__(self):         # parse the command line arguments and open the serial port
+    def __init__(self, comport=None):   # parse the command line arguments and open the serial port
         self.COMPORT=COMPORT
         self.filename=""
-        if len(sys.argv)==1:     # No arguments then try the default serial port
+        if comport!=None:       # opened by another program (TestStation) - let it handle a port that won't open
+            self.COMPORT=comport
+        elif len(sys.argv)==1:     # No arguments then try the default serial port
             pass
         elif len(sys.argv)==2: 
             self.COMPORT=sys.argv[1]
         else:
             self.usage()
             sys.exit()
-        if DEBUG>3: print "COM Port set to {}".format(self.COMPORT)
+        if DEBUG>3: print("COM Port set to {}".format(self.COMPORT))
         try:
             self.UZB= serial.Serial(self.COMPORT,'115200',timeout=2)
         except serial.SerialException:
-            print "Unable to open serial port {}".format(self.COMPORT)
+            if comport!=None:
+                raise
+            print("Unable to open serial port {}".format(self.COMPORT))
             exit()
+        self.transport=SerialAPITransport(self.UZB)
+        self.stats=self.transport.stats     # latency histograms and error counters - m command
+        self.lock=threading.RLock()     # the SerialAPI allows one request at a time - held from send to response
+        self.policy=RetryPolicy()       # adaptive timeouts and the retry budget
+        self.encoder=FrameEncoder()
+        self.readBlock=None     # largest NVM_EXT_READ_BUF length the firmware accepts - found by ProbeReadBlock
+        self.writeBlock=NVM_WRITE_SIZES[0] # largest NVM_EXT_WRITE_BUF length - drops on the first failed write
+        self.nvm=None           # geometry of the external NVM - found once by NVMInfo
+        self.crc16=None         # True if the chip computes the NVM CRC16 for VerifyCRC - found once by ProbeCRC16
+        self.cache=NVMCache(self.ReadNVM)   # page cache for the r command - see CachedRead
 
     def checksum(self,pkt):
         ''' compute the Z-Wave SerialAPI checksum at the end of each frame'''
-        s=0xff
-        for c in pkt:
-            s ^= ord(c)
-        return s
+        return Checksum(pkt)
+
+    def Close(self):
+        ''' Stop the reader thread and close the serial port'''
+        self.transport.Close()
+        self.UZB.close()
 
     def GetRxChar( self, timeout=100):
-        ''' Get a character from the UART or timeout in 100ms'''
-        while timeout >0 and not self.UZB.inWaiting():
-            time.sleep(0.001)
-            timeout -=1
-        if timeout>0:
-            retval= self.UZB.read()
-        else:
-            retval= None
-        return retval
+        ''' Get an ACK/NAK/CAN from the UART or timeout in 100ms'''
+        return self.transport.acks.Get(timeout)
 
     def GetZWave( self, timeout=5000):
-        ''' Receive a frame from the UART and return the binary string or timeout in TIMEOUT ms and return None'''
-        pkt=""
-        c=self.GetRxChar(timeout)
-        if c == None:
-            if DEBUG>1: print "GetZWave Timeout!"
-            return None
-        while ord(c)!=SOF:   # get synced on the SOF
-            if DEBUG>5: print "SerialAPI Not SYNCed {:02X}".format(ord(c))
-            c=self.GetRxChar(timeout)
-        if ord(c)!=SOF:
-            return None
-        length=ord(self.GetRxChar())
-        for i in range(length):
-            c=self.GetRxChar()
-            pkt += c
-        checksum= self.checksum(pkt)
-        checksum ^= length  # checksum includes the length
-        if checksum!=0:
-            if DEBUG>1: print "GetZWave checksum failed {:02x}".format(checksum)
-        self.UZB.write(pack("B",ACK))  # ACK the returned frame - we don't send anything else even if the checksum is wrong
-        return pkt[1:-1] # strip off the type and checksum
+        ''' Receive an unsolicited frame (one not routed to a request or callback) and return the binary string
+            or timeout in TIMEOUT ms and return None'''
+        pkt=self.transport.unsolicited.Get(timeout)
+        if pkt==None:
+            if DEBUG>1: print("GetZWave Timeout!")
+        return pkt
  
  
-    def Send2ZWave( self, SerialAPIcmd, returnStringFlag=False):
+    def Send2ZWave( self, SerialAPIcmd, returnStringFlag=False, data=None, timeout=None):
         ''' Send the command via the SerialAPI to the Z-Wave chip and optionally wait for a response.
-            If ReturnStringFlag=True then returns a binary string of the SerialAPI frame response
-            else returns None
+            If ReturnStringFlag=True then returns the SerialAPI frame response as bytes
+            (waiting up to timeout ms after the ACK - by default derived from the response times measured for
+            the function ID) else returns None. The response is the RESPONSE frame - or for functions
+            that have none, the first callback - with the same function ID. Other frames are left for GetZWave.
             Waits for the ACK/NAK/CAN for the SerialAPI and strips that off. 
-            Removes all SerialAPI data from the UART before sending and ACKs to clear any retries.
+            data is an optional bulk payload (any bytes-like object) appended after SerialAPIcmd without copying it into a new one.
+            Thread safe - concurrent callers take turns since the SerialAPI only allows one request at a time.
+            After a response timed out the next request for the same function ID waits until the late response
+            has been dropped or up to RESPONSE_TIMEOUT_MAX - so a lost response costs that long.
+            Raises SerialAPIError if the frame is not ACKed within the retry limits of self.policy.
         '''
-        if self.UZB.inWaiting(): 
-            self.UZB.write(pack("B",ACK))  # ACK just to clear out any retries
-            if DEBUG>5: print "Dumping ",
-        while self.UZB.inWaiting(): # purge UART RX to remove any old frames we don't want
-            c=self.UZB.read()
-            if DEBUG>5: print "{:02X}".format(ord(c)),
-        frame = pack("2B", len(SerialAPIcmd)+2, REQUEST) + SerialAPIcmd # add LEN and REQ bytes which are part of the checksum
-        chksum= self.checksum(frame)
-        pkt = (pack("B",SOF) + frame + pack("B",chksum)) # add SOF to front and CHECKSUM to end
-        if DEBUG>9: print "Sending ", 
-        for c in pkt:
-            if DEBUG>9: print "{:02X},".format(ord(c)),
-            self.UZB.write(c)  # send the command
-        if DEBUG>9: print " "
-        # should always get an ACK/NAK/CAN so wait for it here
-        c=self.GetRxChar(500) # wait up to half second for the ACK
-        if c==None:
-            if DEBUG>1: print "Error - no ACK or NAK"
-            # try resending one time
-            self.UZB.write(pack("B",ACK))  # ACK just to clear out any retries
-            for c in pkt:
-                self.UZB.write(c)  # resend the command
-            c=self.GetRxChar(1500) # wait for the ACK
-            if c==None:
-                if DEBUG>1: print "Error - No Ack/Nak on 2nd try"
-        elif ord(c)!=ACK:
-            if DEBUG>1: print "Error - not ACKed = 0x{:02X}".format(ord(c))
-            self.UZB.write(pack("B",ACK))   # send an ACK to stop any retries
-            time.sleep(1)
-            while self.UZB.inWaiting(): # purge UART RX to remove any old frames we don't want
-                c=self.UZB.read()
-            for c in pkt:
-                self.UZB.write(c) # resend the command
-            c=self.GetRxChar(500)
-            if c==None:
-                if DEBUG>1: print "ERROR - No Ack/Nak on 2nd try"
+        funcID=SerialAPIcmd[0]
         response=None
-        if returnStringFlag:    # wait for the returning frame for up to 5 seconds
-            response=self.GetZWave()    
+        with self.lock:
+            self.transport.Purge()
+            if returnStringFlag:
+                self.transport.Settle(funcID)
+                waiter=self.transport.Expect(funcID)
+            try:
+                start=time.time()
+                acked=self.SendFrame(SerialAPIcmd, data)
+                if returnStringFlag:    # wait for the returning frame
+                    if timeout==None:
+                        timeout=1000*self.policy.Timeout(funcID, "response")
+                    response=waiter.Get(timeout)
+                    if response==None:
+                        if DEBUG>1: print("No response to function 0x{:02X}".format(funcID))
+                        self.stats.Count("response_timeouts")
+                        self.transport.Stale(funcID, acked)
+                        self.policy.Sample(funcID, "response", timeout/1000.0)  # at least this long - widens the next timeout
+                    else:
+                        now=time.time()
+                        self.stats.Latency(funcID, "response", now-start)
+                        self.policy.Sample(funcID, "response", now-acked)
+            finally:
+                if returnStringFlag:
+                    self.transport.Done(funcID)
         return response
-            
+
+    def SendFrame( self, SerialAPIcmd, data=None):
+        ''' Send one REQUEST frame and wait for the ACK. On a NAK/CAN or missing ACK the frame is resent after
+            the backoff given by self.policy, which raises SerialAPIError when no more retries are allowed.
+            Returns the time the ACK arrived.
+        '''
+        pkt = self.encoder.Encode(SerialAPIcmd, data) # SOF, LEN, REQ, command, data and CHECKSUM in one buffer
+        funcID = self.encoder.buf[3]
+        if DEBUG>9: print("Sending " + pkt.hex(",").upper())
+        attempt=0
+        while True:
+            start=time.time()
+            self.UZB.write(pkt)  # send (or resend) the command
+            self.stats.Count("retries" if attempt else "frames_sent")
+            # should always get an ACK/NAK/CAN so wait for it here
+            c=self.GetRxChar(1000*self.policy.Timeout(funcID, "ack", attempt))
+            if c==ACK:
+                now=time.time()
+                self.stats.Latency(funcID, "ack", now-start)
+                if attempt==0:      # the ACK of a resent frame could belong to either copy - don't time it
+                    self.policy.Sample(funcID, "ack", now-start)
+                self.policy.Acked(attempt)
+                return now
+            if c==None:
+                if DEBUG>1: print("Error - no ACK or NAK")
+                self.stats.Count("ack_timeouts")
+                reason="not ACKed"
+            else:
+                if DEBUG>1: print("Error - not ACKed = 0x{:02X}".format(c))
+                self.stats.Count("naks" if c==NAK else "cans")
+                reason="NAKed" if c==NAK else "CANed"
+            self.UZB.write(ACK_BYTE)   # send an ACK to stop any retries
+            attempt+=1
+            time.sleep(self.policy.Retransmit(funcID, attempt, reason))
+            self.transport.acks.Clear()
+
+    def NVMCmd(self, funcID, addr, length):
+        ''' Header of an NVM_EXT_READ_BUF/WRITE_BUF command: function ID, 24 bit address, 16 bit length'''
+        if addr+length>1<<24:       # would wrap around to the start of the NVM
+            raise ValueError("NVM address 0x{:X} is beyond the 24 bit range".format(addr+length-1))
+        return NVM_CMD.pack(funcID, (addr>>16)&0xFF, addr&0xFFFF, length)
+
+    def ProbeReadBlock(self):
+        ''' Find the largest NVM_EXT_READ_BUF length the firmware returns in full. Probed once and cached.'''
+        if self.readBlock:
+            return self.readBlock
+        for n in NVM_READ_SIZES:
+            for attempt in range(1+NVM_BLOCK_RETRIES):
+                pkt=self.Send2ZWave(self.NVMCmd(FUNC_ID_NVM_EXT_READ_BUF,0,n),True,timeout=NVM_PROBE_TIMEOUT)
+                if pkt!=None:   # a lost response says nothing about the size - only a short one does
+                    break
+            if pkt!=None and len(pkt)==n+1:
+                break
+        self.readBlock=n
+        if DEBUG>3: print("NVM read block size {}".format(n))
+        return n
+
+    def ReadNVM(self, addr, length):
+        ''' Read length bytes of the external NVM starting at addr in the largest blocks the firmware accepts.
+            A block without a response is resent NVM_BLOCK_RETRIES times at the same size before the rest of this
+            read drops to the next smaller size too. When a smaller block at the same address then comes back in full
+            the short response was a firmware limit and the smaller size is kept in self.readBlock for later reads -
+            a read past the end of the NVM is short because of that and changes nothing.
+            Returns a bytearray or None if even the smallest block fails.
+        '''
+        block=self.ProbeReadBlock()
+        buf=bytearray()
+        end=addr+length
+        timeouts=0
+        short=None      # (address, length) of the last short response
+        while addr<end:
+            n=min(block,end-addr)
+            pkt=self.Send2ZWave(self.NVMCmd(FUNC_ID_NVM_EXT_READ_BUF,addr,n),True)
+            if pkt==None and timeouts<NVM_BLOCK_RETRIES:
+                timeouts+=1
+                continue
+            timeouts=0
+            if pkt==None or len(pkt)!=n+1:
+                smaller=[b for b in NVM_READ_SIZES if b<block]
+                if not smaller:
+                    if DEBUG>1: print("NVM read failed at 0x{:06X}".format(addr))
+                    return None
+                block=smaller[0]
+                if pkt!=None and addr+n<=self.NVMSize():  # past the end a read is short whatever the firmware
+                    short=(addr,n)
+                if DEBUG>1: print("NVM read at 0x{:06X} failed - block size now {}".format(addr,block))
+                continue
+            if short and short[0]==addr and n<short[1]:
+                self.readBlock=min(self.readBlock,block)
+            short=None
+            buf+=pkt[1:]    # strip off the function ID
+            addr+=n
+        return buf
+
+    def WriteNVM(self, addr, data):
+        ''' Write data to the external NVM starting at addr in the largest blocks the firmware accepts.
+            A block without a response is resent NVM_BLOCK_RETRIES times at the same size before the rest of this
+            write drops to the next smaller size too. When a smaller block at the same address then succeeds the
+            refused write was a firmware limit and the smaller size is kept in self.writeBlock for later writes -
+            writes past the end of the NVM or to protected or failing flash fail at every size and change nothing.
+            Writes are split at flash page boundaries. Returns True on success.
+        '''
+        page=self.NVMInfo()["page"]
+        view=memoryview(bytearray(data))
+        limit=self.writeBlock   # lowered for this write only when blocks time out
+        timeouts=0
+        refused=None    # (offset, length) of the last write the firmware refused
+        i=0
+        while i<len(view):
+            block=limit=min(limit,self.writeBlock)
+            while page%block:       # keep writes inside one flash page so the chip never has to split them
+                block-=1
+            n=min(block,len(view)-i,page-(addr+i)%page)
+            pkt=self.Send2ZWave(self.NVMCmd(FUNC_ID_NVM_EXT_WRITE_BUF,addr+i,n),True,view[i:i+n])
+            if pkt==None and timeouts<NVM_BLOCK_RETRIES:
+                timeouts+=1
+                continue
+            timeouts=0
+            if pkt==None or len(pkt)<2 or pkt[1]==0:
+                smaller=[b for b in NVM_WRITE_SIZES if b<limit]
+                if not smaller:
+                    if DEBUG>1: print("NVM write failed at 0x{:06X}".format(addr+i))
+                    return False
+                limit=smaller[0]
+                if pkt!=None:
+                    refused=(i,n)
+                if DEBUG>1: print("NVM write at 0x{:06X} failed - block size now {}".format(addr+i,limit))
+                continue
+            if refused and refused[0]==i and n<refused[1]:
+                self.writeBlock=min(self.writeBlock,limit)
+            refused=None
+            with self.lock:
+                self.cache.Update(addr+i,view[i:i+n].tobytes())
+            i+=n
+        return True
+
+    def CachedRead(self, addr, length):
+        ''' Read length bytes at addr thru the page cache - repeated reads of the same pages don't go to the UART.
+            For interactive use only: the Z-Wave protocol itself may change the NVM behind the cache's back.'''
+        with self.lock:
+            return self.cache.Read(addr,length,self.NVMSize())
+
+    def RestoreNVM(self, image, addr=0):
+        ''' Write image to the NVM starting at addr, skipping data the NVM already holds.
+            The NVM is read in large blocks and compared against the image; only the runs that differ are
+            written and then read back to verify them.
+            Returns (skipped, written, verified) byte counts or None if a read or write failed.
+        '''
+        skipped=written=verified=0
+        for start in range(0,len(image),NVM_DUMP_CHUNK):
+            want=bytearray(image[start:start+NVM_DUMP_CHUNK])
+            have=self.ReadNVM(addr+start,len(want))
+            if have==None:
+                return None
+            if have==want:
+                skipped+=len(want)
+                continue
+            runs=[]         # [offset,length] of the runs of compare blocks that differ
+            for i in range(0,len(want),NVM_COMPARE_SIZE):
+                j=i+NVM_COMPARE_SIZE
+                if have[i:j]==want[i:j]:
+                    skipped+=len(want[i:j])
+                elif runs and runs[-1][0]+runs[-1][1]==i:
+                    runs[-1][1]+=len(want[i:j])
+                else:
+                    runs.append([i,len(want[i:j])])
+            for (i,n) in runs:
+                if not self.WriteNVM(addr+start+i,want[i:i+n]):
+                    return None
+                written+=n
+                check=self.ReadNVM(addr+start+i,n)
+                if check!=want[i:i+n]:
+                    print("Verify failed at 0x{:06X}".format(addr+start+i))
+                    return None
+                verified+=n
+        return (skipped,written,verified)
+
+    def ProbeNVM(self):
+        ''' Return the NVM_GET_MFG_ID response (function ID followed by the JEDEC ID bytes) or None'''
+        return self.Send2ZWave(pack("B",FUNC_ID_NVM_GET_MFG_ID),True)
+
+    def NVMInfo(self, refresh=False):
+        ''' Return the geometry of the external NVM (see DecodeJEDEC). The JEDEC ID is read once and cached.'''
+        if self.nvm==None or refresh:
+            pkt=self.ProbeNVM()
+            if pkt==None or len(pkt)<5:
+                if DEBUG>1: print("Unable to read the NVM JEDEC ID - assuming {}KB".format(NVM_DEFAULT_SIZE//1024))
+                return DecodeJEDEC((0,0,0))     # not cached so the next call tries again
+            self.nvm=DecodeJEDEC(pkt[2:5])
+        return self.nvm
+
+    def NVMSize(self):
+        return self.NVMInfo()["size"]
+
+    def LoadDeviceInfo(self, directory=DEVICE_CACHE_DIR):
+        ''' Restore the NVM geometry, block sizes, CRC16 support and round trip times an earlier run saved for
+            this port so none of them have to be probed again. Returns False if nothing was cached.
+            The board on a port changes (a test rack) so the cached geometry and CRC16 support are only used if
+            the JEDEC ID read now (one NVM_GET_MFG_ID frame) matches. The block sizes and round trip times are
+            properties of the firmware and are kept either way.'''
+        try:
+            with open(self.DeviceInfoFile(directory)) as f:
+                info=json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.readBlock=info.get("readBlock")
+        self.writeBlock=info.get("writeBlock") or self.writeBlock
+        for (key,est) in info.get("rtt",{}).items():
+            (funcID,kind)=key.split()
+            self.policy.rtt[(int(funcID,16),kind)]=est
+        nvm=self.NVMInfo()
+        if self.nvm!=None and nvm["jedec"]==(info.get("nvm") or {}).get("jedec"):
+            self.crc16=info.get("crc16")
+        elif DEBUG>3: print("A different board is on {} - NVM {}".format(self.COMPORT, nvm["jedec"]))
+        return True
+
+    def SaveDeviceInfo(self, directory=DEVICE_CACHE_DIR):
+        ''' Save what has been learned about the board on this port for the next run - one file per port'''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        info={"port": self.COMPORT, "nvm": self.nvm, "readBlock": self.readBlock, "writeBlock": self.writeBlock,
+              "crc16": self.crc16, "rtt": dict(("{:02X} {}".format(f,k),est) for ((f,k),est) in self.policy.rtt.items())}
+        with open(self.DeviceInfoFile(directory),"w") as f:
+            json.dump(info, f)
+
+    def DeviceInfoFile(self, directory=DEVICE_CACHE_DIR):
+        return os.path.join(directory, re.sub(r'[^A-Za-z0-9]+', '_', self.COMPORT).strip('_')+".json")
+
+    def HomeID(self):
+        ''' Return (HomeID, NodeID) or None if the chip doesn't answer'''
+        pkt=self.Send2ZWave(pack("B",FUNC_ID_GET_HOME_ID),True)
+        if pkt==None or len(pkt)<HOME_ID_RES.size:
+            return None
+        return HOME_ID_RES.unpack_from(pkt)[1:]
+
+    def DeviceID(self):
+        ''' HomeID and NVM JEDEC ID of the board - the key of its checkpoint journals (see NVMJournal)'''
+        ids=self.HomeID()
+        return "{:08X}_{}".format(ids[0] if ids else 0, self.NVMInfo()["jedec"].replace(" ",""))
+
+    def IterNVM(self, start=0, length=None, chunk=NVM_DUMP_CHUNK):
+        ''' Yield length bytes (the rest of the NVM by default) of the NVM from start as memoryview chunks
+            of up to chunk bytes as they are read. Feed them to NVMStream sinks to save, hash and compare
+            an NVM of any size in one pass. Raises IOError if a read fails.'''
+        if length==None:
+            length=self.NVMSize()-start
+        for addr in range(start,start+length,chunk):
+            data=self.ReadNVM(addr,min(chunk,start+length-addr))
+            if data==None:
+                raise IOError("NVM read failed at 0x{:06X}".format(addr))
+            yield memoryview(data)
+
+    def DumpNVM(self, length=None):
+        ''' Read length bytes (the whole NVM by default) of the NVM from address 0.
+            Returns a bytearray or None if a read failed.'''
+        image=bytearray()
+        try:
+            for data in self.IterNVM(0,length):
+                image+=data
+        except IOError as e:
+            print("Dump failed - {}".format(e))
+            return None
+        return image
+
+    def VerifyNVM(self, image, addr=0):
+        ''' Compare the NVM starting at addr with image. Returns the number of bytes that differ or None if a read failed.'''
+        bad=0
+        for start in range(0,len(image),NVM_DUMP_CHUNK):
+            want=bytearray(image[start:start+NVM_DUMP_CHUNK])
+            have=self.ReadNVM(addr+start,len(want))
+            if have==None:
+                return None
+            if have!=want:
+                bad+=sum(1 for (a,b) in zip(have,want) if a!=b)
+        return bad
+
+    def NVMCRC16(self, addr, length, seed=CRC16_SEED):
+        ''' Return the CRC16 the Z-Wave chip computes over length (up to 65535) bytes of the NVM starting at addr
+            or None if the firmware doesn't answer FIRMWARE_UPDATE_NVM_UPDATE_CRC16'''
+        cmd=CRC16_CMD.pack(FUNC_ID_ZW_FIRMWARE_UPDATE_NVM, FIRMWARE_UPDATE_NVM_UPDATE_CRC16, (addr>>16)&0xFF, addr&0xFFFF, length, seed)
+        pkt=self.Send2ZWave(cmd,True,timeout=CRC16_TIMEOUT)
+        if pkt==None or len(pkt)<CRC16_RES.size:
+            return None
+        return CRC16_RES.unpack_from(pkt)[2]
+
+    def ProbeCRC16(self):
+        ''' Check that the CRC16 the chip computes matches the data read back from two NVM pages at different
+            addresses holding different data that isn't all one value - the first CRC16_PROBE_PAGES are searched.
+            Firmware without the NVM firmware update API (or computing it over a different area) fails the check.
+            The result is cached unless it is a pass over constant data, which can't tell one area from another.'''
+        if self.crc16!=None:
+            return self.crc16
+        pages=[]            # (addr, data) of the pages the CRC16 is checked on
+        for addr in range(0,min(CRC16_PROBE_PAGES*NVM_PAGE,self.NVMSize()),NVM_PAGE):
+            data=self.ReadNVM(addr,NVM_PAGE)
+            if data==None:
+                return False        # not cached so the next call tries again
+            if data.count(data[:1])!=len(data) and data not in [d for (a,d) in pages]:
+                pages.append((addr,data))
+                if len(pages)==2:
+                    break
+        varied=len(pages)>0
+        if not varied:
+            pages=[(addr,data)]
+        ok=all(self.NVMCRC16(a,len(d))==CRC16(d) for (a,d) in pages)
+        if varied or not ok:
+            self.crc16=ok
+        if DEBUG>3: print("NVM CRC16 verify {}{}".format("supported" if ok else "not supported - reading back instead",
+            "" if self.crc16!=None else " (the NVM is blank - checked again next time)"))
+        return ok
+
+    def VerifyCRC(self, image, addr=0):
+        ''' Compare the NVM starting at addr with image using the CRC16 the chip computes over each region.
+            Regions whose CRC differs are bisected down to CRC16_LEAF bytes and only those are read back,
+            so an NVM that matches costs one frame per CRC16_REGION bytes instead of reading all of it.
+            Returns (bad bytes, bytes read back, CRC frames) or None if the chip can't do the CRC or a read failed.
+        '''
+        if not self.ProbeCRC16():
+            return None
+        counts=[0,0,0]
+        for start in range(0,len(image),CRC16_REGION):
+            if self.CheckRegion(image, addr, start, min(CRC16_REGION,len(image)-start), counts)==None:
+                return None
+        return tuple(counts)
+
+    def CheckRegion(self, image, addr, start, length, counts, differs=False):
+        ''' Check one region of VerifyCRC and bisect it if it differs - differs=True skips the CRC when it is
+            already known (the first half of a region that differs matched). Returns True if it matched,
+            False if it differed or None on a failure.'''
+        want=bytearray(image[start:start+length])
+        if not differs:
+            crc=self.NVMCRC16(addr+start,length)
+            counts[2]+=1
+            if crc==None:
+                return None
+            if crc==CRC16(want):
+                return True
+        if length<=CRC16_LEAF:
+            have=self.ReadNVM(addr+start,length)
+            if have==None:
+                return None
+            counts[1]+=length
+            counts[0]+=sum(1 for (a,b) in zip(have,want) if a!=b)
+            if DEBUG>3: print("NVM differs at 0x{:06X}-0x{:06X}".format(addr+start,addr+start+length-1))
+            return False
+        half=length//2
+        first=self.CheckRegion(image, addr, start, half, counts)
+        if first==None:
+            return None
+        if self.CheckRegion(image, addr, start+half, length-half, counts, first)==None:
+            return None
+        return False
 
     def RemoveLifeline( self, NodeID):
         ''' Remove the Lifeline Association from the NodeID (integer). 
             Helps eliminate interfering traffic being sent to the controller during the middle of range testing.
         '''
+        callback=self.transport.Callback(FUNC_ID_ZW_SEND_DATA, 78)
         pkt=self.Send2ZWave(pack("!9B",FUNC_ID_ZW_SEND_DATA, NodeID, 4, 0x85, 0x04, 0x01, 0x01, TXOPTS, 78),True)
-        pkt=self.GetZWave(10*1000)
-        if pkt==None or ord(pkt[2])!=0:
-            if DEBUG>1: print "Failed to remove Lifeline"
+        pkt=callback.Get(10*1000)
+        self.transport.Release(FUNC_ID_ZW_SEND_DATA, 78)
+        if pkt==None or len(pkt)<STATUS_CB.size or STATUS_CB.unpack_from(pkt)[2]!=TRANSMIT_COMPLETE_OK:
+            if DEBUG>1: print("Failed to remove Lifeline")
         else:
-            print "Lifeline removed"
-        if DEBUG>10: 
-            for i in range(len(pkt)): 
-                print "{:02X}".format(ord(pkt[i])),
+            print("Lifeline removed")
+        if DEBUG>10 and pkt!=None: 
+            print(pkt.hex(" ").upper())
 
     def PrintVersion(self):
         pkt=self.Send2ZWave(pack("B",FUNC_ID_SERIAL_API_GET_CAPABILITIES),True)
-        if pkt==None: 
-            print "Failed to communicate with Z-Wave Chip"
+        if pkt==None or len(pkt)<CAPABILITIES_RES.size: 
+            print("Failed to communicate with Z-Wave Chip")
             return
-        (ver, rev, man_id, man_prod_type, man_prod_type_id, supported) = unpack("!2B3H32s", pkt[1:])
-        print "SerialAPI Ver={0}.{1}".format(ver,rev)   # SerialAPI version is different than the SDK version
-        print "Mfg={:04X}".format(man_id)
-        print "ProdID/TypeID={0:02X}:{1:02X}".format(man_prod_type,man_prod_type_id)
+        (cmd, ver, rev, man_id, man_prod_type, man_prod_type_id, supported) = CAPABILITIES_RES.unpack_from(pkt)
+        print("SerialAPI Ver={0}.{1}".format(ver,rev))   # SerialAPI version is different than the SDK version
+        print("Mfg={:04X}".format(man_id))
+        print("ProdID/TypeID={0:02X}:{1:02X}".format(man_prod_type,man_prod_type_id))
         pkt=self.Send2ZWave(pack("B",FUNC_ID_ZW_GET_VERSION),True)  # SDK version
-        (VerStr, lib) = unpack("!12sB", pkt[1:])
-        print "{} {}".format(VerStr,ZWAVE_VER_DECODE[VerStr[-5:-1]])
-        print "Library={} {}".format(lib,libType[lib])
+        if pkt!=None and len(pkt)>=VERSION_RES.size:
+            (cmd, VerStr, lib) = VERSION_RES.unpack_from(pkt)
+            VerStr=VerStr.split(b"\0")[0].decode("ascii","replace")   # "Z-Wave 6.01"
+            print("{} {}".format(VerStr,ZWAVE_VER_DECODE.get(VerStr[-4:],"SDK unknown")))
+            print("Library={} {}".format(lib,libType.get(lib,"unknown")))
         pkt=self.Send2ZWave(pack("B",FUNC_ID_SERIAL_API_GET_INIT_DATA),True)
         if pkt!=None and len(pkt)>33:
-            print "NodeIDs=",
+            print("NodeIDs=", end=' ')
             for k in [4,28+4]:
-                j=ord(pkt[k]) # this is the first 8 nodes
+                j=pkt[k] # this is the first 8 nodes
                 for i in range(0,8):
                     if (1<<i)&j:
-                        print "{},".format(i+1+ 8*(k-4)),
-            print " "
+                        print("{},".format(i+1+ 8*(k-4)), end=' ')
+            print(" ")
         pkt=self.Send2ZWave(pack("BB",FUNC_ID_ZW_FIRMWARE_UPDATE_NVM,FIRMWARE_UPDATE_NVM_INIT),True)
-        (cmd, FirmwareUpdateSupported) = unpack("!BB", pkt[1:])
+        if pkt!=None and len(pkt)>=3:
+            (cmd, FirmwareUpdateSupported) = pkt[1:3]
 
     def usage(self):
-        print ""
-        print "Usage: python TestNVM.py [COMxx]"
-        print " COMxx is the Z-Wave UART interface - typically COMxx for windows and /dev/ttyXXXX for Linux"
-        print "Version {}".format(VERSION)
-        print "Commands:"
-        print "p=Probe the NVM and report MFG and size"
-        print "h=Print the HomeID and NodeID"
-        print "d=dump the NVM contents to the file NVM.hex"
-        print "f [dd] = Fill the entire NVM with the value dd (0 by default)"
-        print "s=Soft Reset the Z-Wave chip (reboot)"
-        print "S=Factory Reset the Z-Wave chip - NVM is initialized, Z-Wave network deleted, ZW_SetDefault()"
-        print "r [aaaaaa]=Read 256 bytes starting at address aaaaaa in hex"
-        print "v=Print SDK Version of the controller and other info"
-        print "+=Include a node"
-        print "-=Exclude a node"
-        print "x=Exit program"
-        print ""
+        print("")
+        print("Usage: python3 TestNVM.py [COMxx] [COMMAND ARGS]")
+        print(" COMxx is the Z-Wave UART interface - typically COMxx for windows and /dev/ttyXXXX for Linux")
+        print(" COMMAND is one of {} - runs it and prints the result as JSON (-h for help)".format(", ".join(COMMANDS)))
+        print("Version {}".format(VERSION))
+        print("Commands:")
+        print("p=Probe the NVM and report MFG, size, page and sector size (used to size d, f, t and R)")
+        print("h=Print the HomeID and NodeID")
+        print("d [file] [ref]=dump the NVM contents to file (NVM.hex by default). The extension selects the format:")
+        print("   .bin=raw, .nvm=compact (erased/constant runs not stored), .ihex=Intel HEX, otherwise the NVM.hex layout")
+        print("   - is stdout and tcp:host:port a raw stream to a socket. Prints the SHA-256 and CRC16 of the NVM and")
+        print("   if a ref image is given the address ranges that differ from it - all in the same single pass")
+        print("f [dd] = Fill the entire NVM with the value dd (FF by default) - only chunks that differ are written")
+        print("R [file] = Restore a dump file in any of the d formats (NVM.hex by default) - only chunks that differ are written")
+        print("V [file] = Verify the NVM against a dump file (NVM.hex by default) using the CRC16 computed by the Z-Wave chip")
+        print("   - only regions whose CRC differs are read back (falls back to reading it all if the firmware can't)")
+        print("t [pattern|all] [seed] = Memory test the entire NVM with checkerboard, inverse, walking1, address, random or all")
+        print("   patterns - DESTROYS the NVM contents. Bad addresses/bits and timings are saved in MemTest.json")
+        print("   d, f, R and t checkpoint their progress in {}/ - after a failure or ^C run them again to resume".format(NVMJournal.JOURNAL_DIR))
+        print("s=Soft Reset the Z-Wave chip (reboot)")
+        print("S=Factory Reset the Z-Wave chip - NVM is initialized, Z-Wave network deleted, ZW_SetDefault()")
+        print("r [aaaaaa]=Read 256 bytes starting at address aaaaaa in hex - thru a page cache with read-ahead")
+        print("v=Print SDK Version of the controller and other info")
+        print("m [file]=Print the SerialAPI latency/error metrics or save them as JSON to file (saved to {} on exit)".format(METRICS_FILE))
+        print("+=Include a node")
+        print("-=Exclude a node")
+        print("x=Exit program")
+        print("")
+
+
+COMMANDS = ("probe", "dump", "fill", "restore", "verify", "read", "write", "reset")
+EXIT_OK       = 0       # command succeeded
+EXIT_FAILED   = 1       # command ran but failed - NVM differs, write failed, read failed...
+EXIT_USAGE    = 2       # bad arguments or an input file that can't be read (argparse exits with 2 too)
+EXIT_NO_DEVICE = 3      # serial port won't open or the Z-Wave chip doesn't answer
+
+def ArgType(name, parse):
+    ''' argparse type= callable applying parse to the argument - a bad one is a usage error (exit code 2)
+        found before the serial port is opened'''
+    def Parse(text):
+        try:
+            return parse(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid {}: {!r}".format(name, text))
+    return Parse
+
+def Checked(value, low, high):
+    ''' Return value (a number or the length of bytes) if it is within low..high - ValueError otherwise'''
+    n=len(value) if isinstance(value, bytearray) else value
+    if not low<=n<=high:
+        raise ValueError("out of range")
+    return value
+
+HEX_BYTE = ArgType("hex byte", lambda text: Checked(int(text,16), 0, 0xFF))
+HEX_ADDR = ArgType("hex NVM address", lambda text: Checked(int(text,16), 0, 0xFFFFFF))
+LENGTH   = ArgType("length", lambda text: Checked(int(text,0), 1, 0x1000000))
+HEX_DATA = ArgType("hex data", lambda text: Checked(bytearray.fromhex(text), 1, 0x1000000))
+
+def Main(port, argv):
+    ''' Run one subcommand non-interactively and print its result as one line of JSON on stdout.
+        Progress messages go to stderr. Device info is only queried when the command needs it and is cached
+        per port in DEVICE_CACHE_DIR between runs. Returns the exit code.
+    '''
+    global DEBUG
+    parser=argparse.ArgumentParser(prog="TestNVM.py [PORT]", description="Scripted Z-Wave NVM commands - "
+        "results are printed as JSON. Run without a command for the interactive menu.")
+    parser.add_argument("--no-cache", action="store_true", help="ignore the device info cached for the port")
+    parser.add_argument("--debug", type=int, default=1, help="debug level of the messages on stderr (0-10)")
+    sub=parser.add_subparsers(dest="command", metavar="COMMAND")
+    sub.required=True       # options alone (PORT --no-cache) are a usage error - not an empty run
+    sub.add_parser("probe", help="read the NVM JEDEC ID and the HomeID")
+    p=sub.add_parser("dump", help="dump the NVM to FILE (- is stdout in the NVM.hex layout - the JSON result then goes to stderr) and its SHA-256")
+    p.add_argument("file")
+    p.add_argument("--ref", help="also compare with this image in the same pass - exit code 1 if it differs")
+    p=sub.add_parser("fill", help="fill the NVM with the hex VALUE - only chunks that differ are written")
+    p.add_argument("value", nargs="?", default="FF", type=HEX_BYTE)
+    p=sub.add_parser("restore", help="write IMAGE to the NVM - only chunks that differ are written")
+    p.add_argument("file")
+    p=sub.add_parser("verify", help="compare the NVM with IMAGE - exit code 1 if it differs")
+    p.add_argument("file")
+    p=sub.add_parser("read", help="read LENGTH bytes (256 by default) at the hex ADDR")
+    p.add_argument("addr", type=HEX_ADDR)
+    p.add_argument("length", nargs="?", default="256", type=LENGTH)
+    p=sub.add_parser("write", help="write the hex DATA bytes at the hex ADDR")
+    p.add_argument("addr", type=HEX_ADDR)
+    p.add_argument("data", type=HEX_DATA)
+    p=sub.add_parser("reset", help="soft reset the Z-Wave chip")
+    p.add_argument("--factory", action="store_true", help="ZW_SetDefault first - erases the Z-Wave network")
+    args=parser.parse_args(argv)
+    DEBUG=args.debug
+    out=sys.stdout
+    sys.stdout=sys.stderr   # everything printed along the way is progress - stdout is only the JSON result
+    result={"command": args.command, "port": port or COMPORT}
+    start=time.time()
+    image=ref=None
+    try:                    # read the input files first so a bad one fails before the port is touched
+        if args.command in ("restore", "verify"):
+            image=LoadImage(args.file)
+        if args.command=="dump" and args.ref:
+            ref=LoadImage(args.ref)
+        code=None
+    except (IOError, ValueError) as e:
+        result["error"]=str(e)
+        code=EXIT_USAGE
+    if code==None:
+        try:
+            zw=TestNVM(port or COMPORT)
+            try:
+                if not args.no_cache:
+                    zw.LoadDeviceInfo()
+                code=RunCommand(zw, args, image, ref, result, out)
+                if code==EXIT_OK:   # what a failed command learned may be wrong - a block size lowered by a bad write
+                    zw.SaveDeviceInfo()
+            finally:
+                zw.Close()
+        except (serial.SerialException, SerialAPIError) as e:
+            result["error"]=str(e)
+            code=EXIT_NO_DEVICE
+        except (IOError, ValueError) as e:
+            result["error"]=str(e)
+            code=EXIT_FAILED
+    result["status"]="pass" if code==EXIT_OK else "fail"
+    result["seconds"]=round(time.time()-start,3)
+    sys.stdout=out
+    if args.command=="dump" and args.file=="-":
+        print(json.dumps(result, sort_keys=True), file=sys.stderr)     # stdout is the dump itself
+    else:
+        print(json.dumps(result, sort_keys=True))
+    return code
+
+def RunCommand(zw, args, image, ref, result, out):
+    ''' Run the subcommand in args on zw and fill in result. Returns the exit code.'''
+    if args.command=="probe":
+        nvm=zw.NVMInfo(True)
+        if zw.nvm==None:
+            raise SerialAPIError("no response to NVM_GET_MFG_ID")
+        result.update(nvm)
+        ids=zw.HomeID()
+        if ids!=None:
+            result["home_id"]="{:08X}".format(ids[0])
+            result["node_id"]=ids[1]
+        return EXIT_OK
+    if args.command=="dump":
+        sinks=[NVMStream.DigestSink()]
+        if args.file=="-":
+            sinks.append(NVMStream.HexSink(out))
+            chunks=zw.IterNVM()
+        else:
+            sinks.append(NVMStream.ImageSink(args.file))
+            chunks=zw.IterNVM() if args.file.startswith("tcp:") else NVMJournal.Dump(zw, args.file)
+        if ref!=None:
+            sinks.append(NVMStream.DiffSink(ref))
+        results=NVMStream.Pump(chunks, NVMStream.Tee(*sinks))
+        result.update(results[0])
+        result["file"]=args.file
+        if ref!=None:
+            result.update(results[2])
+            return EXIT_FAILED if results[2]["bad_bytes"] else EXIT_OK
+        return EXIT_OK
+    if args.command in ("fill", "restore"):
+        if args.command=="fill":
+            image=bytearray([args.value])*zw.NVMSize()
+        elif len(image)>zw.NVMSize():
+            raise ValueError("{} is {} bytes - larger than the {} byte NVM".format(args.file, len(image), zw.NVMSize()))
+        counts=NVMJournal.Restore(zw, image, args.command)
+        if counts==None:
+            result["error"]="NVM {} failed - run it again to resume".format(args.command)
+            return EXIT_FAILED
+        (result["skipped"], result["written"], result["verified"])=counts
+        return EXIT_OK
+    if args.command=="verify":
+        counts=zw.VerifyCRC(image)
+        if counts!=None:
+            (bad, result["read_bytes"], result["crc_frames"])=counts
+        else:
+            bad=zw.VerifyNVM(image)
+            result["read_bytes"]=len(image)
+        if bad==None:
+            raise IOError("NVM read failed")
+        result["bad_bytes"]=bad
+        return EXIT_FAILED if bad else EXIT_OK
+    if args.command in ("read", "write"):
+        (addr, length)=(args.addr, args.length if args.command=="read" else len(args.data))
+        if addr+length>zw.NVMSize():
+            result["error"]="0x{:06X}+{} is past the end of the {} byte NVM".format(addr, length, zw.NVMSize())
+            return EXIT_USAGE
+    if args.command=="read":
+        data=zw.ReadNVM(addr, length)
+        if data==None:
+            raise IOError("NVM read failed at 0x{:06X}".format(addr))
+        result["addr"]="0x{:06X}".format(addr)
+        result["data"]=data.hex().upper()
+        return EXIT_OK
+    if args.command=="write":
+        data=args.data
+        result["addr"]="0x{:06X}".format(addr)
+        result["bytes"]=len(data)
+        return EXIT_OK if zw.WriteNVM(addr, data) else EXIT_FAILED
+    if args.command=="reset":
+        if args.factory:
+            zw.Send2ZWave(pack("B", FUNC_ID_ZW_SET_DEFAULT),False)
+            time.sleep(1.5)     # wait for the NVM to be initialized
+        zw.Send2ZWave(pack("B", FUNC_ID_SERIAL_API_SOFT_RESET),False)
+        pkt=zw.GetZWave(RESET_TIMEOUT)   # the SERIAL_API_STARTED frame - none from older firmware
+        result["started"]=pkt!=None and pkt[0]==FUNC_ID_SERIAL_API_STARTED
+        return EXIT_OK
 
 if __name__ == "__main__":
     ''' Start the app if this file is executed'''
+    argv=sys.argv[1:]
+    port=None
+    if argv and argv[0] not in COMMANDS and not argv[0].startswith("-"):
+        port=argv.pop(0)
+    if argv:                # a subcommand - run it and exit without the menu
+        sys.exit(Main(port, argv))
     try:
         self=TestNVM()
     except:
-        print 'error - unable to start program'
+        print('error - unable to start program')
         self.usage()
         exit()
 
+    def Shutdown():
+        ''' Stop the reader thread and save the metrics however the menu ends - x, ^D or ^C at the prompt or an error'''
+        self.Close()
+        with open(METRICS_FILE,"w") as f:
+            json.dump(self.stats.Snapshot(), f, indent=2)
+    atexit.register(Shutdown)
+
     # fetch and display various attributes of the Controller
-    self.PrintVersion()
+    try:
+        self.PrintVersion()
+    except SerialAPIError as e:
+        print("Failed to communicate with Z-Wave Chip - {}".format(e))
 
     while True:
-        line = raw_input('>')
+        try:
+            line = input('>')
+        except (EOFError, KeyboardInterrupt):   # ^D or ^C at the prompt - exit like x
+            print("")
+            break
         if len(line)<1: 
             line=' '
-        if line[0] == 'X' or line[0] == 'x' or line[0] == 'q':  ############## exit
-            break
-        elif line[0] == 'p':                          ############## probe - print out the NVM MFG and size
-            pkt=self.Send2ZWave(pack("B",FUNC_ID_NVM_GET_MFG_ID),True) 
-            print "{:02X} {:02X} {:02X} {:02X} {:02X}".format(ord(pkt[0]),ord(pkt[1]),ord(pkt[2]),ord(pkt[3]),ord(pkt[4])),
-            print " Mfg=",
-            if ord(pkt[2])==0x20: 
-                print "Micron",
-                size=ord(pkt[4])
-                if 0x0e<size<0x18:
-                    size2=16<<(size-0x0e) 
-                    print "Size={}KB".format(size2)
-            elif ord(pkt[2])==0x1f: 
-                print "Adesto",
-                size=ord(pkt[3])
-                if (size&0x1F)==0x03:   # TODO decode some of the other sizes
-                    print "Size=2MBit (256KB)"
+        try:
+            if line[0] == 'X' or line[0] == 'x' or line[0] == 'q':  ############## exit
+                break
+            elif line[0] == 'p':                          ############## probe - print out the NVM MFG and size
+                nvm=self.NVMInfo(True)
+                print("JEDEC ID={} Mfg={} Size={}KB Page={} Sector={}".format(nvm["jedec"], nvm["mfg"], nvm["size"]//1024, nvm["page"], nvm["sector"]), end=' ')
+                if not nvm["known"]:
+                    print("(size unknown - assuming {}KB)".format(NVM_DEFAULT_SIZE//1024), end=' ')
+                print("")
+
+            elif line[0] == 'h':                          ############## Get the HomeID NodeID
+                ids=self.HomeID()
+                if ids==None:
+                    print("Failed to get the HomeID")
+                    continue
+                print("HomeID={:X} NodeID={}".format(*ids))
+
+            elif line[0] == 's':                          ############## soft reset
+                pkt=self.Send2ZWave(pack("B", FUNC_ID_SERIAL_API_SOFT_RESET),False) 
+                time.sleep(1.5)         # wait for reset to complete
+                pkt=self.GetZWave()          # clear the Start command
+                self.cache.Clear()      # the firmware may rewrite the NVM as it starts
+                print("Reset Complete")
+
+            elif line[0] == 'S':                          ############## SET_DEFAULT - factory reset
+                pkt=self.Send2ZWave(pack("B", FUNC_ID_ZW_SET_DEFAULT),False) 
+                time.sleep(1.5)         # wait for reset to complete
+                pkt=self.Send2ZWave(pack("B", FUNC_ID_SERIAL_API_SOFT_RESET),False) 
+                pkt=self.GetZWave()          # clear the Start command
+                self.cache.Clear()
+                print("Factory Reset Complete")
+
+            elif line[0] == 'r':                          ############## Read 256 bytes at page xxx
+                linesplit=line.split()
+                if len(linesplit)>1:
+                    addr=int(linesplit[1],16)
                 else:
-                    print "Size={:02X}".format(ord(pkt3))
-            else: print "{:02X}".format(ord(pkt[3]))
-
-        elif line[0] == 'h':                          ############## Get the HomeID NodeID
-            pkt=self.Send2ZWave(pack("B",FUNC_ID_GET_HOME_ID),True) 
-            HomeID = int(ord(pkt[1]))
-            HomeID=HomeID<<8
-            HomeID += ord(pkt[2])
-            HomeID = HomeID<<8 
-            HomeID += ord(pkt[3])
-            HomeID = HomeID<<8
-            HomeID += ord(pkt[4])
-            NodeID=ord(pkt[5])
-            print "HomeID={:X} NodeID={}".format(HomeID, NodeID)
-
-        elif line[0] == 's':                          ############## soft reset
-            pkt=self.Send2ZWave(pack("B", FUNC_ID_SERIAL_API_SOFT_RESET),False) 
-            time.sleep(1.5)         # wait for reset to complete
-            pkt=self.GetZWave()          # clear the Start command
-            print "Reset Complete"
-
-        elif line[0] == 'S':                          ############## SET_DEFAULT - factory reset
-            pkt=self.Send2ZWave(pack("B", FUNC_ID_ZW_SET_DEFAULT),False) 
-            time.sleep(1.5)         # wait for reset to complete
-            pkt=self.Send2ZWave(pack("B", FUNC_ID_SERIAL_API_SOFT_RESET),False) 
-            pkt=self.GetZWave()          # clear the Start command
-            print "Factory Reset Complete"
-
-        elif line[0] == 'r':                          ############## Read 256 bytes at page xxx
-            linesplit=line.split()
-            if len(linesplit)>1:
-                addr=int(linesplit[1],16)
-            else:
-                addr=0
-            for i in range(0,16):
-                pkt=self.Send2ZWave(pack("BBBBBB",FUNC_ID_NVM_EXT_READ_BUF,(addr>>16)&0xFF,(addr>>8)&0xFF,(addr>>0)&0xFF ,0,16),True) 
-                print "\r\n0x{:06X}=".format(addr),
-                addr+=16
-                for j in range(1,17):
-                    print "{:02X}".format(ord(pkt[j])),
-            print " "
-
-        elif line[0] == 'w':                          ############## Write a single byte to address aaaaaa
-            linesplit=line.split()
-            if len(linesplit)>2:
-                addr=int(linesplit[1],16)
-                data=int(linesplit[2],16)
-            else:
-                print "w aaaaaa dd - write dd to address aaaaaa. Values are in hex"
-            pkt=self.Send2ZWave(pack("B3BB",FUNC_ID_NVM_EXT_WRITE_BYTE,(addr>>16)&0xFF,(addr>>8)&0xFF,(addr>>0)&0xFF ,data),True) 
-            if pkt[1] != 0:
-                print "Write of {:X} to {:X} complete".format(data,addr)
-            else:
-                print "Write failed"
+                    addr=0
+                data=self.CachedRead(addr,256)
+                if data==None:
+                    print("Read failed")
+                    continue
+                for i in range(0,256,16):
+                    print("0x{:06X}= {}".format(addr+i, data[i:i+16].hex(" ").upper()))
+
+            elif line[0] == 'w':                          ############## Write a single byte to address aaaaaa
+                linesplit=line.split()
+                if len(linesplit)>2:
+                    addr=int(linesplit[1],16)
+                    data=int(linesplit[2],16)
+                else:
+                    print("w aaaaaa dd - write dd to address aaaaaa. Values are in hex")
+                    continue
+                pkt=self.Send2ZWave(NVM_WRITE_BYTE.pack(FUNC_ID_NVM_EXT_WRITE_BYTE,(addr>>16)&0xFF,addr&0xFFFF,data),True) 
+                self.cache.Invalidate(addr)
+                if pkt!=None and len(pkt)>1 and pkt[1] != 0:
+                    print("Write of {:X} to {:X} complete".format(data,addr))
+                else:
+                    print("Write failed")
 
-        elif line[0] == 'f':                          ############## fill the entire NVM with the value included 
-            linesplit=line.split()
-            if len(linesplit)>1:
-                val=int(linesplit[1],16)
+            elif line[0] == 'f':                          ############## fill the entire NVM with the value included 
+                linesplit=line.split()
+                if len(linesplit)>1:
+                    val=int(linesplit[1],16)
+                else:
+                    val=0xFF
+                print("Writing {:02X} to entire NVM - Please wait...".format(val))
+                result=NVMJournal.Restore(self, bytearray([val])*self.NVMSize(), "fill")
+                if result==None:
+                    print("Fill failed - run it again to resume")
+                else:
+                    print("Fill completed - skipped {} written {} verified {} bytes".format(*result))
+
+            elif line[0] == 'R':                          ############## restore a dump file back into the NVM
+                linesplit=line.split()
+                if len(linesplit)>1:
+                    filename=linesplit[1]
+                else:
+                    filename="NVM.hex"
+                try:
+                    image=LoadImage(filename)
+                except (IOError, ValueError) as e:
+                    print("unable to read {} - {}".format(filename,e))
+                    continue
+                if len(image)>self.NVMSize():
+                    print("{} is {} bytes - larger than the {} byte NVM".format(filename,len(image),self.NVMSize()))
+                    continue
+                print("Restoring {} ({} bytes) - Please wait...".format(filename,len(image)))
+                result=NVMJournal.Restore(self, image, "restore")
+                if result==None:
+                    print("Restore failed - run it again to resume")
+                else:
+                    print("Restore completed - skipped {} written {} verified {} bytes".format(*result))
+
+            elif line[0] == 'V':                          ############## verify the NVM against a dump file with the chip CRC16
+                linesplit=line.split()
+                if len(linesplit)>1:
+                    filename=linesplit[1]
+                else:
+                    filename="NVM.hex"
+                try:
+                    image=LoadImage(filename)
+                except (IOError, ValueError) as e:
+                    print("unable to read {} - {}".format(filename,e))
+                    continue
+                print("Verifying {} ({} bytes) - Please wait...".format(filename,len(image)))
+                start=time.time()
+                result=self.VerifyCRC(image)
+                if result!=None:
+                    (bad, readback, frames)=result
+                    print("{} CRC16 requests, {} bytes read back".format(frames, readback), end=' ')
+                else:
+                    bad=self.VerifyNVM(image)
+                    if bad==None:
+                        print("Verify failed - unable to read the NVM")
+                        continue
+                    print("{} bytes read back".format(len(image)), end=' ')
+                print("in {:.1f}s - {}".format(time.time()-start, "{} bytes differ".format(bad) if bad else "NVM matches {}".format(filename)))
+
+            elif line[0] == 'd':                          ############## dump the entire NVM to a file - NVM.hex by default
+                linesplit=line.split()
+                if len(linesplit)>1:
+                    filename=linesplit[1]
+                else:
+                    filename="NVM.hex"
+                sinks=[NVMStream.DigestSink()]
+                try:
+                    sinks.append(NVMStream.ImageSink(filename))
+                    if len(linesplit)>2:
+                        sinks.append(NVMStream.DiffSink(LoadImage(linesplit[2])))
+                except (IOError, ValueError) as e:
+                    print("unable to open {} - {}".format(" ".join(linesplit[1:]),e))
+                    continue
+                print("Please wait...")
+                try:
+                    if filename=="-" or filename.startswith("tcp:"):
+                        chunks=self.IterNVM()
+                    else:           # checkpointed in a part file per board so a failed dump resumes
+                        chunks=NVMJournal.Dump(self, filename)
+                    results=NVMStream.Pump(chunks, NVMStream.Tee(*sinks))
+                except IOError as e:
+                    print("Dump failed - {} - run it again to resume".format(e))
+                    continue
+                print("Dump completed - {bytes} bytes SHA-256={sha256} CRC16={crc16}".format(**results[0]))
+                if len(results)>2:
+                    diff=results[2]
+                    print("{} bytes differ from {}".format(diff["bad_bytes"],linesplit[2]), end=' ')
+                    print(" ".join("0x{:06X}-0x{:06X}".format(a,b) for (a,b) in diff["ranges"][:20]))
+
+            elif line[0] == 't':                          ############## memory test - write and read back test patterns over the entire NVM
+                linesplit=line.split()
+                patterns=MemTest.PATTERNS
+                if len(linesplit)>1 and linesplit[1]!="all":
+                    patterns=[linesplit[1]]
+                seed=1
+                if len(linesplit)>2:
+                    seed=int(linesplit[2])
+                if [p for p in patterns if p not in MemTest.PATTERNS]:
+                    print("t [pattern|all] [seed] - patterns are {}".format(", ".join(MemTest.PATTERNS)))
+                    continue
+                print("Testing {} - Please wait...".format(", ".join(patterns)))
+                journal=NVMJournal.Open(self, "memtest-{}-{}".format("+".join(patterns), seed), self.NVMSize())
+                result=MemTest.RunMemTest(self, patterns, self.NVMSize(), seed, journal)
+                if not [r for r in result["patterns"] if r["error"]]:
+                    journal.Finish()        # otherwise kept so running it again retries the chunks that failed
+                for r in result["patterns"]:
+                    print("{:<13} {} bad bytes={} bad bits={} write={}s verify={}s {}".format(r["pattern"], "PASS" if r["pass"] else "FAIL",
+                        r["bad_bytes"], r["bad_bits"], r["write_seconds"], r["verify_seconds"], r["error"] or ""))
+                with open("MemTest.json","w") as f:
+                    json.dump(result, f, indent=2)
+                print("Memory test {} in {}s - details in MemTest.json".format("PASSED" if result["pass"] else "FAILED", result["seconds"]))
+
+            elif line[0] == 'm':                          ############## print the transport metrics or save them as JSON
+                linesplit=line.split()
+                if len(linesplit)>1:
+                    with open(linesplit[1],"w") as f:
+                        json.dump(self.stats.Snapshot(), f, indent=2)
+                    print("Metrics saved to {}".format(linesplit[1]))
+                else:
+                    self.stats.Print()
+
+            elif line[0]=='v':                          ########################## Print the version of the controller
+                self.PrintVersion()
+
+            elif line[0]=='+':                          ########################## Inclusion mode
+                callback=self.transport.Callback(FUNC_ID_ZW_ADD_NODE_TO_NETWORK, 0xaa) # status callbacks are routed here
+                self.Send2ZWave(pack("3B",FUNC_ID_ZW_ADD_NODE_TO_NETWORK, ADD_NODE_ANY, 0xaa),False)
+                bStatus=ADD_NODE_STATUS_FAILED
+                pkt=callback.Get()
+                if pkt!=None:
+                    (cmd,FuncID,bStatus)= STATUS_CB.unpack_from(pkt) # first status should be 01=learn_ready
+                if (bStatus==ADD_NODE_STATUS_LEARN_READY):
+                    print("Press Button on Device")
+                while not (bStatus==ADD_NODE_STATUS_FAILED or bStatus==ADD_NODE_STATUS_DONE): # will get several callbacks until DONE with info along the way
+                    pkt=callback.Get(50*1000)      # wait for up to 50seconds for a response
+                    if pkt==None:
+                        bStatus=ADD_NODE_STATUS_FAILED
+                        break
+                    (cmd,FuncID,bStatus)= STATUS_CB.unpack_from(pkt)
+                    #print "Adding Status={}".format(bStatus)
+                    if bStatus==ADD_NODE_STATUS_PROTOCOL_DONE: # required to send it again to get to DONE
+                        pkt=self.Send2ZWave(pack("3B",FUNC_ID_ZW_ADD_NODE_TO_NETWORK, ADD_NODE_STOP, 0xaa),False)
+                    if (bStatus==ADD_NODE_STATUS_ADDING_SLAVE or bStatus==ADD_NODE_STATUS_ADDING_CONTROLLER):
+                        stuff=pkt[3]
+                        print("Added Node {}".format(stuff))
+                if bStatus==ADD_NODE_STATUS_FAILED:
+                    print("Add node failed")
+                self.transport.Release(FUNC_ID_ZW_ADD_NODE_TO_NETWORK, 0xaa)
+                self.cache.Clear()      # the node table and routing data have changed
+                self.Send2ZWave(pack("BB",FUNC_ID_ZW_ADD_NODE_TO_NETWORK, ADD_NODE_STOP),False) # cleanup
+
+            elif line[0]=='-':                          ############################### Exclusion mode
+                callback=self.transport.Callback(FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK, 0xdd) # status callbacks are routed here
+                self.Send2ZWave(pack("3B",FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK, REMOVE_NODE_ANY, 0xdd),False) # go into exclude mode
+                bStatus=REMOVE_NODE_STATUS_FAILED
+                pkt=callback.Get()
+                if pkt!=None:
+                    (cmd,FuncID,bStatus)= STATUS_CB.unpack_from(pkt) # first status should be 01=learn_ready
+                if (bStatus==REMOVE_NODE_STATUS_LEARN_READY):
+                    print("Press Button on Device")
+                while not (bStatus==REMOVE_NODE_STATUS_FAILED or bStatus==REMOVE_NODE_STATUS_DONE): # will get several callbacks until DONE with info along the way
+                    pkt=callback.Get(50*1000)      # wait for up to 50seconds for a response
+                    if pkt==None:
+                        break
+                    (cmd,FuncID,bStatus)= STATUS_CB.unpack_from(pkt)
+                    if (bStatus==REMOVE_NODE_STATUS_REMOVING_SLAVE or bStatus==REMOVE_NODE_STATUS_REMOVING_CONTROLLER):
+                        stuff=pkt[3]
+                        print("Excluded Node {}".format(stuff))
+                self.transport.Release(FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK, 0xdd)
+                self.cache.Clear()
+                self.Send2ZWave(pack("BB",FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK, REMOVE_NODE_STOP),False) # cleanup
             else:
-                val=0xFF
-            print "Writing {:02X} to entire NVM - Please wait...".format(val)
-            addr=0x0
-            for i in range(0,256*1024/16):
-                pkt=self.Send2ZWave(pack("B3B2B16B",FUNC_ID_NVM_EXT_WRITE_BUF,(addr>>16)&0xFF,(addr>>8)&0xFF,(addr>>0)&0xFF,0, 16,
-                    val,val,val,val,val,val,val,val,
-                    val,val,val,val,val,val,val,val),True) 
-                addr+=16
-                if DEBUG>9: print "{:X}={:x}".format(addr,ord(pkt[1]))
-
-        elif line[0] == 'd':                          ############## dump the entire NVM to a filed called NVM.hex (assumes a 2mbit NVM)
-            # TODO could try to figure out the size here and then just dump the actual size
-            try:
-                f=open("NVM.hex","w")
-            except:
-                print "unable to open NVM.hex"
-                continue
-            print "Please wait..."
-            addr=0
-            for i in range(0,256*1024/16):
-                pkt=self.Send2ZWave(pack("BBBBBB",FUNC_ID_NVM_EXT_READ_BUF,(addr>>16)&0xFF,(addr>>8)&0xFF,(addr>>0)&0xFF ,0,16),True) 
-                f.write("\r\n0x{:06X}=".format(addr))
-                addr+=16
-                for j in range(1,17):
-                    f.write("{:02X}".format(ord(pkt[j])))
-            f.close()
-            print "Dump completed"
-
-        elif line[0]=='v':                          ########################## Print the version of the controller
-            self.PrintVersion()
-
-        elif line[0]=='+':                          ########################## Inclusion mode
-            pkt=self.Send2ZWave(pack("3B",FUNC_ID_ZW_ADD_NODE_TO_NETWORK, ADD_NODE_ANY, 0xaa),True)
-            (cmd,FuncID,bStatus)= unpack("BBB",pkt[:3]) # first status should be 01=learn_ready
-            if (bStatus==ADD_NODE_STATUS_LEARN_READY):
-                print "Press Button on Device"
-            while not (bStatus==ADD_NODE_STATUS_FAILED or bStatus==ADD_NODE_STATUS_DONE): # will get several callbacks until DONE with info along the way
-                pkt=self.GetZWave(50*1000)      # wait for up to 50seconds for a response
-                (cmd,FuncID,bStatus)= unpack("BBB",pkt[:3])
-                #print "Adding Status={}".format(bStatus)
-                if bStatus==ADD_NODE_STATUS_PROTOCOL_DONE: # required to send it again to get to DONE
-                    pkt=self.Send2ZWave(pack("3B",FUNC_ID_ZW_ADD_NODE_TO_NETWORK, ADD_NODE_STOP, 0xaa),False)
-                if (bStatus==ADD_NODE_STATUS_ADDING_SLAVE or bStatus==ADD_NODE_STATUS_ADDING_CONTROLLER):
-                    stuff,=unpack("B",pkt[3])
-                    print "Added Node {}".format(stuff)
-            if bStatus==ADD_NODE_STATUS_FAILED:
-                print "Add node failed"
-            self.Send2ZWave(pack("BB",FUNC_ID_ZW_ADD_NODE_TO_NETWORK, ADD_NODE_STOP),False) # cleanup
-
-        elif line[0]=='-':                          ############################### Exclusion mode
-            pkt=self.Send2ZWave(pack("3B",FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK, REMOVE_NODE_ANY, 0xdd),True) # go into exclude mode but wait up to 60 seconds for a response
-            (cmd,FuncID,bStatus)= unpack("BBB",pkt[:3]) # first status should be 01=learn_ready
-            if (bStatus==REMOVE_NODE_STATUS_LEARN_READY):
-                print "Press Button on Device"
-            while not (bStatus==REMOVE_NODE_STATUS_FAILED or bStatus==REMOVE_NODE_STATUS_DONE): # will get several callbacks until DONE with info along the way
-                pkt=self.GetZWave(50*1000)      # wait for up to 50seconds for a response
-                (cmd,FuncID,bStatus)= unpack("BBB",pkt[:3])
-                if (bStatus==REMOVE_NODE_STATUS_REMOVING_SLAVE or bStatus==REMOVE_NODE_STATUS_REMOVING_CONTROLLER):
-                    stuff,=unpack("B",pkt[3])
-                    print "Excluded Node {}".format(stuff)
-            self.Send2ZWave(pack("BB",FUNC_ID_ZW_REMOVE_NODE_FROM_NETWORK, REMOVE_NODE_STOP),False) # cleanup
-        else:
-            self.usage()
+                self.usage()
+        except SerialAPIError as e:    # the link to the chip failed - the command is abandoned
+            print("SerialAPI error - {}".format(e))
+        except KeyboardInterrupt:
+            print("Interrupted - d, f, R and t resume where they stopped when run again")
     exit()
@@ -0,0 +1,159 @@
+''' Z-Wave NVM Test Station
+
+    Runs the same TestNVM operation on many Z-Wave modules at once - one thread per serial port.
+    Each board has its own serial port and TestNVM instance so a slow or hung board does not stall the others.
+    TestNVM is blocking code (see SerialAPITransport for why) so each board takes a worker thread here and
+    a reader thread in its transport.
+    The per-board results and timings are combined into one report which can also be saved as JSON.
+
+    Usage: python3 TestStation.py [-j N] [-t SECONDS] [-o report.json] OPERATION [ARG] PORT [PORT...]
+    PORT can be a glob such as /dev/ttyUSB* which is expanded here (handy on Windows where the shell doesn't).
+    Operations:
+        probe                   read and decode the NVM JEDEC ID
+        dump DIR                dump each NVM to DIR/NVM_<port>.bin (any NVMImage extension with -x) and its SHA-256
+        fill VALUE              fill each NVM with the hex VALUE - only chunks that differ are written
+        restore IMAGE           write IMAGE to each NVM - only chunks that differ are written
+        verify IMAGE            compare each NVM with IMAGE - by CRC16 on the chip when the firmware supports it
+
+    Requires Python 3.8 or newer like TestNVM
+'''
+
+import sys
+import os
+import re
+import glob
+import time
+import json
+import argparse
+import threading
+import TestNVM
+import NVMStream
+from NVMImage          import LoadImage
+
+OPERATIONS = ("probe", "dump", "fill", "restore", "verify")
+TIMEOUT    = 15*60      # seconds a board gets before it is reported as hung
+
+def ExpandPorts(ports):
+    ''' Expand any globs in the list of ports and drop duplicates keeping the order'''
+    expanded=[]
+    for p in ports:
+        for q in (sorted(glob.glob(p)) if glob.has_magic(p) else [p]):
+            if q not in expanded:
+                expanded.append(q)
+    return expanded
+
+def PortName(port):
+    ''' Turn a port such as /dev/ttyUSB0 or COM3 into something usable in a filename'''
+    return re.sub(r'[^A-Za-z0-9]+', '_', os.path.basename(port)).strip('_')
+
+def RunBoard(port, args, image, result):
+    ''' Run the operation on the board on port and fill in the result dictionary'''
+    start=time.time()
+    try:
+        zw=TestNVM.TestNVM(port)
+        try:
+            if args.operation=="probe":
+                nvm=zw.NVMInfo()
+                if not nvm["known"]:
+                    raise IOError("unknown NVM JEDEC ID {}".format(nvm["jedec"]))
+                result.update(nvm)
+            elif args.operation=="dump":
+                filename=os.path.join(args.arg, "NVM_{}{}".format(PortName(port), args.ext))
+                (digest, saved)=NVMStream.Pump(zw.IterNVM(), NVMStream.Tee(NVMStream.DigestSink(), NVMStream.ImageSink(filename)))
+                result["file"]=filename
+                result["sha256"]=digest["sha256"]
+            elif args.operation in ("fill", "restore"):
+                if args.operation=="fill":      # sized to each board's NVM
+                    image=bytearray([int(args.arg,16)])*zw.NVMSize()
+                counts=zw.RestoreNVM(image)
+                if counts==None:
+                    raise IOError("NVM {} failed".format(args.operation))
+                (result["skipped"], result["written"], result["verified"])=counts
+            elif args.operation=="verify":
+                counts=zw.VerifyCRC(image)
+                if counts!=None:
+                    (bad, result["read_bytes"], result["crc_frames"])=counts
+                else:
+                    bad=zw.VerifyNVM(image)
+                if bad==None:
+                    raise IOError("NVM read failed")
+                result["bad_bytes"]=bad
+                if bad:
+                    raise IOError("{} bytes differ".format(bad))
+        finally:                # release the port and stop the reader thread whatever happened
+            zw.Close()
+        result["status"]="pass"
+    except Exception as e:
+        result["status"]="fail"
+        result["error"]=str(e)
+    result["seconds"]=round(time.time()-start,3)
+
+def RunStation(ports, args, image=None):
+    ''' Run the operation on every port at the same time with at most args.jobs boards active.
+        Boards still running after args.timeout seconds are reported as hung and left behind (daemon threads).
+        Returns the list of per-board result dictionaries in port order.
+    '''
+    slots=threading.Semaphore(args.jobs)
+    results=[]
+    threads=[]
+    def Worker(port, result):
+        with slots:
+            result["status"]="running"
+            RunBoard(port, args, image, result)
+    for port in ports:
+        result={"port": port, "status": "waiting"}
+        t=threading.Thread(target=Worker, args=(port, result))
+        t.daemon=True      # a hung board must not keep the program from exiting
+        t.start()
+        results.append(result)
+        threads.append(t)
+    deadline=time.time()+args.timeout
+    for (t,result) in zip(threads,results):
+        t.join(max(0,deadline-time.time()))
+        if t.is_alive():
+            result["status"]="hung" if result["status"]=="running" else "not run"
+            result["error"]="did not finish within {} seconds".format(args.timeout)
+            result["seconds"]=args.timeout
+    return results
+
+def PrintReport(results, elapsed):
+    ''' Print one line per board and a summary'''
+    for r in results:
+        details=" ".join("{}={}".format(k,r[k]) for k in sorted(r) if k not in ("port","status","seconds"))
+        print("{:<20} {:<8} {:>8}s {}".format(r["port"], r["status"], r.get("seconds",""), details))
+    passed=sum(1 for r in results if r["status"]=="pass")
+    print("{} of {} boards passed in {:.1f}s".format(passed, len(results), elapsed))
+
+if __name__ == "__main__":
+    ''' Start the station if this file is executed'''
+    parser=argparse.ArgumentParser(description="Run a TestNVM operation on many Z-Wave modules at once")
+    parser.add_argument("-j", "--jobs", type=int, default=16, help="maximum number of boards run at the same time")
+    parser.add_argument("-t", "--timeout", type=float, default=TIMEOUT, help="seconds before a board is reported as hung")
+    parser.add_argument("-o", "--output", help="also save the report as JSON to this file")
+    parser.add_argument("-x", "--ext", default=".bin", help="image format extension used by dump")
+    parser.add_argument("operation", choices=OPERATIONS)
+    parser.add_argument("args", nargs="+", metavar="ARG/PORT", help="operation argument (if any) followed by the ports")
+    args=parser.parse_args()
+    args.arg=None
+    if args.operation!="probe":
+        args.arg=args.args.pop(0)
+    ports=ExpandPorts(args.args)
+    if not ports:
+        parser.error("no serial ports given")
+
+    image=None
+    if args.operation in ("restore", "verify"):
+        image=LoadImage(args.arg)
+    elif args.operation=="dump" and not os.path.isdir(args.arg):
+        os.makedirs(args.arg)
+
+    TestNVM.DEBUG=1     # boards print over each other otherwise - errors are in the report
+    start=time.time()
+    results=RunStation(ports, args, image)
+    elapsed=time.time()-start
+    PrintReport(results, elapsed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"operation": args.operation, "argument": args.arg, "seconds": round(elapsed,3),
+                "boards": results}, f, indent=2)
+    sys.exit(0 if all(r["status"]=="pass" for r in results) else 1)